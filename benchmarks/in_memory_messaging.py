@@ -0,0 +1,104 @@
+"""
+Measures the per-message cost of the in-memory messaging repo as messages accumulate.
+
+Run with `poetry run python benchmarks/in_memory_messaging.py`.
+The cost per message should stay flat from the first to the last batch,
+and not grow with the number of subscribers of other topics, or of consumers waiting for messages.
+"""
+import asyncio
+import time
+
+from stable_diffusion_api.engine.repos.messaging_repo import InMemoryMessagingRepo
+
+TOTAL_MESSAGES = 100_000
+BATCH_SIZE = 10_000
+CROWD_SIZES = [1, 100, 1000]
+CROWD_MESSAGES = 10_000
+
+
+async def benchmark_pubsub() -> None:
+    publisher = InMemoryMessagingRepo()
+    subscriber = InMemoryMessagingRepo()
+    await subscriber.subscribe('benchmark')
+    listener = subscriber.listen()
+
+    for batch in range(TOTAL_MESSAGES // BATCH_SIZE):
+        start = time.perf_counter()
+        for i in range(BATCH_SIZE):
+            publisher.publish('benchmark', str(i))
+            await listener.__anext__()
+        elapsed = time.perf_counter() - start
+        print(f'pubsub, after {(batch + 1) * BATCH_SIZE} messages: {elapsed / BATCH_SIZE * 1e6:.2f} us/message')
+
+
+async def benchmark_queue() -> None:
+    repo = InMemoryMessagingRepo()
+
+    for batch in range(TOTAL_MESSAGES // BATCH_SIZE):
+        start = time.perf_counter()
+        for i in range(BATCH_SIZE):
+            repo.push('benchmark', str(i), group=str(i % 10))
+        for _ in range(BATCH_SIZE):
+            await repo.pop('benchmark')
+        elapsed = time.perf_counter() - start
+        print(f'queue, after {(batch + 1) * BATCH_SIZE} messages: {elapsed / BATCH_SIZE * 1e6:.2f} us/message')
+
+
+async def benchmark_pubsub_crowd(subscribers: int) -> None:
+    # every other subscriber listens to a topic of its own, like one websocket per session
+    publisher = InMemoryMessagingRepo()
+    listeners = []
+    for i in range(subscribers):
+        subscriber = InMemoryMessagingRepo()
+        await subscriber.subscribe(f'benchmark:{i}')
+        listeners.append(subscriber.listen())
+    idle = [asyncio.create_task(listener.__anext__()) for listener in listeners[1:]]
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    for i in range(CROWD_MESSAGES):
+        publisher.publish('benchmark:0', str(i))
+        await listeners[0].__anext__()
+    elapsed = time.perf_counter() - start
+    print(f'pubsub, with {subscribers} subscribers: {elapsed / CROWD_MESSAGES * 1e6:.2f} us/message')
+
+    for task in idle:
+        task.cancel()
+    await asyncio.gather(*idle, return_exceptions=True)
+
+
+async def benchmark_queue_crowd(waiters: int) -> None:
+    # each message wakes one of the consumers waiting for it
+    repo = InMemoryMessagingRepo()
+    received = asyncio.Queue()
+
+    async def consume() -> None:
+        while True:
+            received.put_nowait(await repo.pop('benchmark:crowd'))
+
+    consumers = [asyncio.create_task(consume()) for _ in range(waiters)]
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    for i in range(CROWD_MESSAGES):
+        repo.push('benchmark:crowd', str(i))
+        await received.get()
+    elapsed = time.perf_counter() - start
+    print(f'queue, with {waiters} waiting consumers: {elapsed / CROWD_MESSAGES * 1e6:.2f} us/message')
+
+    for task in consumers:
+        task.cancel()
+    await asyncio.gather(*consumers, return_exceptions=True)
+
+
+async def main() -> None:
+    await benchmark_pubsub()
+    await benchmark_queue()
+    for crowd_size in CROWD_SIZES:
+        await benchmark_pubsub_crowd(crowd_size)
+    for crowd_size in CROWD_SIZES:
+        await benchmark_queue_crowd(crowd_size)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,2 +1,2 @@
 #!/bin/bash
-poetry run python -m stable_diffusion_api.engine.workers.redis_worker
\ No newline at end of file
+poetry run python -m stable_diffusion_api.engine.workers.supervisor
\ No newline at end of file
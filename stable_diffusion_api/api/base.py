@@ -1,9 +1,12 @@
 import asyncio
+import contextlib
+import math
 import os
 import datetime
+import time
 import uuid
 from collections import defaultdict
-from typing import Type, Union, Optional, AsyncGenerator
+from typing import Type, Union, Optional, AsyncIterator
 
 import bcrypt
 import pydantic
@@ -23,13 +26,15 @@ from stable_diffusion_api.engine.repos.key_value_repo import KeyValueRepo
 from stable_diffusion_api.engine.repos.messaging_repo import MessagingRepo
 from stable_diffusion_api.engine.repos.user_repo import UserRepo
 from stable_diffusion_api.engine.services.event_service import EventListener, EventService
+from stable_diffusion_api.engine.services.metrics_service import MetricsService
 from stable_diffusion_api.engine.services.status_service import StatusService
-from stable_diffusion_api.engine.services.task_service import TaskService
+from stable_diffusion_api.engine.services.task_service import TaskService, TaskRejectedException, \
+    UserQueueFullException
 from stable_diffusion_api.models.blob import BlobToken, BlobUrl
-from stable_diffusion_api.models.events import EventUnion, FinishedEvent, AbortedEvent
+from stable_diffusion_api.models.events import EventUnion, FinishedEvent, AbortedEvent, PendingEvent
 from stable_diffusion_api.models.results import GeneratedBlob
 from stable_diffusion_api.models.params import Txt2ImgParams, Img2ImgParams, ParamsUnion
-from stable_diffusion_api.models.task import TaskId, Task
+from stable_diffusion_api.models.task import TaskId, Task, SchedulingPolicy
 from stable_diffusion_api.models.user import UserBase, AuthenticationError, User, AuthToken
 
 
@@ -48,6 +53,19 @@ class AppConfig(pydantic.BaseModel):
     ENABLE_PUBLIC_ACCESS: bool = pydantic.Field(default_factory=lambda: os.environ["ENABLE_PUBLIC_ACCESS"] == "1")
     ENABLE_SIGNUP: bool = pydantic.Field(default_factory=lambda: os.environ["ENABLE_SIGNUP"] == "1")
 
+    SCHEDULING_POLICY: SchedulingPolicy = pydantic.Field(
+        default_factory=lambda: os.environ.get("SCHEDULING_POLICY", "fifo"))
+    SJF_AGING_FACTOR: float = pydantic.Field(default_factory=lambda: float(os.environ.get("SJF_AGING_FACTOR", 10)))
+
+    MAX_QUEUE_LENGTH: int = pydantic.Field(default_factory=lambda: int(os.environ.get("MAX_QUEUE_LENGTH", 0)))
+    MAX_USER_QUEUE_LENGTH: int = pydantic.Field(default_factory=lambda: int(os.environ.get("MAX_USER_QUEUE_LENGTH", 0)))
+    MAX_ESTIMATED_WAIT: float = pydantic.Field(default_factory=lambda: float(os.environ.get("MAX_ESTIMATED_WAIT", 0)))
+
+    SYNC_REQUEST_TIMEOUT: float = pydantic.Field(
+        default_factory=lambda: float(os.environ.get("SYNC_REQUEST_TIMEOUT", 300)))
+
+    EVENT_LOG_LENGTH: int = pydantic.Field(default_factory=lambda: int(os.environ.get("EVENT_LOG_LENGTH", 100)))
+
 
 def create_app(app_config: AppConfig) -> FastAPI:
     app = FastAPI(
@@ -89,10 +107,10 @@ def create_app(app_config: AppConfig) -> FastAPI:
             # create an ephemeral public user session
             # no token means no way to receive events on websocket (auth per session identified by token)
             # can still poll task status and use blobs though (auth by username, i.e. "all")
-            token = user_repo.create_public_token().access_token
+            token = (await user_repo.acreate_public_token()).access_token
 
         try:
-            return user_repo.must_get_user_by_token(token)
+            return await user_repo.amust_get_user_by_token(token)
         except AuthenticationError:
             raise credentials_exception
 
@@ -100,7 +118,7 @@ def create_app(app_config: AppConfig) -> FastAPI:
     async def login_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
                                  user_repo: UserRepo = Depends(construct_user_repo)) -> AuthToken:
         try:
-            return user_repo.create_token_by_username_and_password(form_data.username, form_data.password)
+            return await user_repo.acreate_token_by_username_and_password(form_data.username, form_data.password)
         except AuthenticationError:
             raise credentials_exception
 
@@ -108,7 +126,7 @@ def create_app(app_config: AppConfig) -> FastAPI:
     async def public_access_token(user_repo: UserRepo = Depends(construct_user_repo)) -> AuthToken:
         if not app_config.ENABLE_PUBLIC_ACCESS:
             raise HTTPException(status_code=403, detail="Public token is disabled")
-        return user_repo.create_public_token()
+        return await user_repo.acreate_public_token()
 
     @app.post("/user/{username}", response_model=UserBase)
     async def signup(username: str,
@@ -119,7 +137,7 @@ def create_app(app_config: AppConfig) -> FastAPI:
         user = UserBase(
             username=username,
         )
-        user_repo.create_user(user, password)
+        await user_repo.acreate_user(user, password)
         return user
 
     ###
@@ -146,19 +164,52 @@ def create_app(app_config: AppConfig) -> FastAPI:
         return EventService(
             messaging_repo=messaging_repo,
             status_service=status_service,
+            event_log_length=app_config.EVENT_LOG_LENGTH,
+        )
+
+    async def construct_metrics_service(
+        key_value_repo: KeyValueRepo = Depends(construct_key_value_repo),
+    ) -> MetricsService:
+        return MetricsService(
+            key_value_repo=key_value_repo,
         )
 
     async def construct_task_service(
         messaging_repo: MessagingRepo = Depends(construct_messaging_repo),
         event_service: EventService = Depends(construct_event_service),
         status_service: StatusService = Depends(construct_status_service),
+        metrics_service: MetricsService = Depends(construct_metrics_service),
     ):
         return TaskService(
             messaging_repo=messaging_repo,
             event_service=event_service,
             status_service=status_service,
+            metrics_service=metrics_service,
+            scheduling_policy=app_config.SCHEDULING_POLICY,
+            sjf_aging_factor=app_config.SJF_AGING_FACTOR,
+            max_queue_length=app_config.MAX_QUEUE_LENGTH,
+            max_user_queue_length=app_config.MAX_USER_QUEUE_LENGTH,
+            max_estimated_wait=app_config.MAX_ESTIMATED_WAIT,
         )
 
+    rejected_task_responses = {
+        429: {"description": "Too many queued tasks for this user"},
+        503: {"description": "Task queue is full, or the estimated wait is too long"},
+    }
+    sync_task_responses = rejected_task_responses | {
+        504: {"description": "Task did not finish within SYNC_REQUEST_TIMEOUT"},
+    }
+
+    async def submit_task(task_service: TaskService, task: Task) -> None:
+        try:
+            await task_service.apush_task(task)
+        except TaskRejectedException as e:
+            raise HTTPException(
+                status_code=429 if isinstance(e, UserQueueFullException) else 503,
+                detail=e.reason,
+                headers={"Retry-After": str(max(math.ceil(e.retry_after), 1))},
+            )
+
     async def construct_blob_repo() -> BlobRepo:
         if issubclass(app_config.blob_repo_class, LocalBlobRepo):
             return app_config.blob_repo_class(
@@ -175,20 +226,9 @@ def create_app(app_config: AppConfig) -> FastAPI:
     queues_by_session_id: dict[str, list[asyncio.Queue]] = defaultdict(list)
     queues_by_task_id: dict[TaskId, list[asyncio.Queue]] = defaultdict(list)
 
-    listener_ready: bool = False
-
-    async def event_listener():
-        nonlocal listener_ready
-
-        # instantiate the event listener
-        listener = EventListener(
-            messaging_repo=app_config.messaging_repo_class(),
-        )
-
-        # initialize listener
-        await listener.initialize()
-        listener_ready = True
+    listener: Optional[EventListener] = None
 
+    async def event_listener(listener: EventListener):
         async for session_id, event in listener.listen():
             for queue in queues_by_session_id[session_id]:
                 await queue.put(event)
@@ -199,56 +239,82 @@ def create_app(app_config: AppConfig) -> FastAPI:
 
     @app.on_event("startup")
     async def startup_event():
+        nonlocal listener
         nonlocal listener_task
-        listener_task = asyncio.create_task(event_listener())
-        # only start the app when the listener is ready
-        while not listener_ready:
-            await asyncio.sleep(0.1)
+        # the listener only subscribes to the sessions that this app's clients are waiting on
+        listener = EventListener(
+            messaging_repo=app_config.messaging_repo_class(),
+        )
+        listener_task = asyncio.create_task(event_listener(listener))
 
     @app.on_event("shutdown")
     async def shutdown_event():
+        nonlocal listener
         nonlocal listener_task
-        nonlocal listener_ready
         queues_by_session_id.clear()
         queues_by_task_id.clear()
         if listener_task is not None:
             listener_task.cancel()
             listener_task = None
-            listener_ready = False
+            listener = None
 
-    async def subscribe_to_session(session_id: str) -> AsyncGenerator[EventUnion, None]:
-        queue = asyncio.Queue()
-        queues_by_session_id[session_id].append(queue)
-        try:
-            while True:
-                yield await queue.get()
-        finally:
-            queues_by_session_id[session_id].remove(queue)
+    # events are only received from the moment of subscribing, so subscribe before pushing a task
 
-    async def subscribe_to_task(task_id: TaskId) -> AsyncGenerator[EventUnion, None]:
-        queue = asyncio.Queue()
-        queues_by_task_id[task_id].append(queue)
+    @contextlib.asynccontextmanager
+    async def listen_to_session(session_id: str) -> AsyncIterator[None]:
+        # unsubscribe from the same listener, in case the app restarts in the meantime
+        session_listener = listener
+        assert session_listener is not None
+        await session_listener.subscribe_session(session_id)
         try:
-            while True:
-                yield await queue.get()
+            yield
         finally:
-            queues_by_task_id[task_id].remove(queue)
+            await session_listener.unsubscribe_session(session_id)
+
+    @contextlib.asynccontextmanager
+    async def subscribe_to_session(session_id: str) -> AsyncIterator[asyncio.Queue]:
+        async with listen_to_session(session_id):
+            queue = asyncio.Queue()
+            queues_by_session_id[session_id].append(queue)
+            try:
+                yield queue
+            finally:
+                if queue in queues_by_session_id[session_id]:
+                    queues_by_session_id[session_id].remove(queue)
+
+    @contextlib.asynccontextmanager
+    async def subscribe_to_task(task: Task) -> AsyncIterator[asyncio.Queue]:
+        # the task's events are published to its user's session
+        async with listen_to_session(task.user.session_id):
+            queue = asyncio.Queue()
+            queues_by_task_id[task.task_id].append(queue)
+            try:
+                yield queue
+            finally:
+                if queue in queues_by_task_id[task.task_id]:
+                    queues_by_task_id[task.task_id].remove(queue)
 
     ###
     # Asynchronous API
     ###
 
-    @app.post("/task", response_model=TaskId)
+    @app.post("/task", response_model=TaskId, responses=rejected_task_responses)
     async def create_task(
         parameters: ParamsUnion,
+        timeout: Optional[float] = Query(
+            default=None,
+            gt=0,
+            description="Seconds after which the task is aborted if it hasn't started yet.",
+        ),
         task_service: TaskService = Depends(construct_task_service),
         user: User = Depends(get_user),
     ) -> TaskId:
         task = Task(
             parameters=parameters,
             user=user,
+            deadline=None if timeout is None else time.time() + timeout,
         )
-        task_service.push_task(task)
+        await submit_task(task_service, task)
         return task.task_id
 
     @app.get("/task/{task_id}", response_model=EventUnion)
@@ -256,16 +322,20 @@ def create_app(app_config: AppConfig) -> FastAPI:
         task_id: TaskId,
         response: Response,
         status_service: StatusService = Depends(construct_status_service),
+        task_service: TaskService = Depends(construct_task_service),
         user: User = Depends(get_user),
     ) -> EventUnion:
         response.headers["Cache-Control"] = "no-cache, no-store"  # don't cache poll requests
 
-        task = status_service.get_task(task_id)
+        task = await status_service.aget_task(task_id)
         if task is None or task.user.username != user.username:
             raise HTTPException(status_code=404, detail="Task not found")
-        event = status_service.get_latest_event(task_id)
+        event = await status_service.aget_latest_event(task_id)
         if event is None:
             raise RuntimeError("Task exists but no event found")
+        if isinstance(event, PendingEvent):
+            # the queue position changes as the queue drains
+            event = (await task_service.aget_pending_event(task)).copy(update={'event_id': event.event_id})
         return event
 
     @app.delete("/task/{task_id}", responses={
@@ -277,12 +347,27 @@ def create_app(app_config: AppConfig) -> FastAPI:
         status_service: StatusService = Depends(construct_status_service),
         user: User = Depends(get_user),
     ):
-        task = status_service.get_task(task_id)
+        task = await status_service.aget_task(task_id)
         if task is None or task.user.username != user.username:
             raise HTTPException(status_code=404, detail="Task not found")
-        status_service.cancel_task(task.task_id)
+        await status_service.acancel_task(task.task_id)
         return Response(status_code=204)
 
+    ###
+    # Metrics
+    ###
+
+    @app.get("/metrics/queue_wait", response_model=dict[SchedulingPolicy, dict[str, int]])
+    async def get_queue_wait_histograms(
+        metrics_service: MetricsService = Depends(construct_metrics_service),
+        user: User = Depends(get_user),
+    ) -> dict[SchedulingPolicy, dict[str, int]]:
+        # how many tasks waited up to each bucket's bound to be dispatched, per scheduling policy
+        return {
+            policy: await metrics_service.aget_queue_wait_histogram(policy)
+            for policy in typing.get_args(SchedulingPolicy)
+        }
+
     ###
     # Blobs (eventually to be replaced with a proper object store, and pre-signed POST/GET URLs)
     ###
@@ -303,7 +388,7 @@ def create_app(app_config: AppConfig) -> FastAPI:
         blob_token: BlobToken,
         blob_repo: LocalBlobRepo = Depends(construct_blob_repo),
     ) -> Response:
-        blob = blob_repo.get_blob_by_token(blob_token)
+        blob = await blob_repo.aget_blob_by_token(blob_token)
         if blob is None:
             raise HTTPException(status_code=404, detail="Blob not found")
         return Response(content=blob, media_type="image/png")
@@ -316,7 +401,7 @@ def create_app(app_config: AppConfig) -> FastAPI:
         blob_data: UploadFile = File(),
         blob_repo: LocalBlobRepo = Depends(construct_blob_repo),
     ) -> BlobUrl:
-        return blob_repo.put_blob(blob_data.file.read())
+        return await blob_repo.aput_blob(await blob_data.read())
 
     ###
     # Synchronous API (convenience wrappers for the asynchronous API)
@@ -324,31 +409,37 @@ def create_app(app_config: AppConfig) -> FastAPI:
 
     async def wait_task_finished(
         task: Task,
+        events: asyncio.Queue,
         request: Request,
         status_service: StatusService,
     ) -> FinishedEvent:
         async def get_finished_event_or_raise():
-            async for ev in subscribe_to_task(task.task_id):
+            while True:
+                ev = await events.get()
                 if isinstance(ev, AbortedEvent):
                     raise HTTPException(status_code=500, detail=ev.reason)
                 if isinstance(ev, FinishedEvent):
                     return ev
-            raise RuntimeError("Event stream ended unexpectedly")
 
         async def disconnect_listener() -> None:
             while not await request.is_disconnected():
                 await asyncio.sleep(0.1)
 
         done, pending = await asyncio.wait([get_finished_event_or_raise(), disconnect_listener()],
+                                           timeout=task.deadline - time.time() if task.deadline else None,
                                            return_when=asyncio.FIRST_COMPLETED)
 
         for aio_task in pending:
             aio_task.cancel()
 
         if await request.is_disconnected():
-            status_service.cancel_task(task.task_id)
+            await status_service.acancel_task(task.task_id)
             raise HTTPException(status_code=499, detail="Client disconnected")
 
+        if not done:
+            await status_service.acancel_task(task.task_id)
+            raise HTTPException(status_code=504, detail="Task did not finish in time")
+
         event = done.pop().result()
         if event is None:
             raise RuntimeError("Event stream ended unexpectedly")
@@ -358,6 +449,7 @@ def create_app(app_config: AppConfig) -> FastAPI:
         @app.get(
             f'/{param_type._endpoint_stem}',
             summary=param_type._endpoint_stem,
+            responses=sync_task_responses,
         )
         async def get_endpoint(
             request: Request,
@@ -369,9 +461,12 @@ def create_app(app_config: AppConfig) -> FastAPI:
             task = Task(
                 parameters=parameters,
                 user=user,
+                priority="interactive",
+                deadline=time.time() + app_config.SYNC_REQUEST_TIMEOUT,
             )
-            task_service.push_task(task)
-            event = await wait_task_finished(task, request, status_service)
+            async with subscribe_to_task(task) as events:
+                await submit_task(task_service, task)
+                event = await wait_task_finished(task, events, request, status_service)
             return event.result
 
     ###
@@ -388,7 +483,7 @@ def create_app(app_config: AppConfig) -> FastAPI:
             raise HTTPException(status_code=401, detail="Unauthorized")
 
         try:
-            return user_repo.must_get_user_by_token(token)
+            return await user_repo.amust_get_user_by_token(token)
         except AuthenticationError:
             await websocket.close(code=1008, reason="Invalid token")
             raise HTTPException(status_code=401, detail="User not found")
@@ -396,11 +491,28 @@ def create_app(app_config: AppConfig) -> FastAPI:
     @app.websocket('/events')
     async def websocket_endpoint(
         websocket: websockets.WebSocket,
+        last_event_id: Optional[str] = Query(default=None),
         user: User = Depends(get_ws_user),
+        event_service: EventService = Depends(construct_event_service),
     ):
         await websocket.accept()
-        async for event in subscribe_to_session(user.session_id):
-            await websocket.send_json(event.json())
+        async with subscribe_to_session(user.session_id) as events:
+            # subscribed before reading the log, so events sent in between are received live, but not twice
+            replayed_event_ids = set()
+            if last_event_id is not None:
+                try:
+                    missed_events = await event_service.aget_events_after(user.session_id, last_event_id)
+                except ValueError:
+                    await websocket.close(code=1008, reason="Invalid last_event_id")
+                    return
+                for event in missed_events:
+                    replayed_event_ids.add(event.event_id)
+                    await websocket.send_json(event.json())
+            while True:
+                event = await events.get()
+                if event.event_id in replayed_event_ids:
+                    continue
+                await websocket.send_json(event.json())
         await websocket.close()
 
     ###
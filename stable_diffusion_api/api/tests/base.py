@@ -1,4 +1,5 @@
 import asyncio
+import contextlib
 import io
 import json
 import urllib.parse
@@ -9,7 +10,9 @@ import pytest
 import pytest_asyncio
 import requests
 
+from stable_diffusion_api.api.base import AppConfig
 from stable_diffusion_api.api.tests.utils import AppClient
+from stable_diffusion_api.engine.services.task_service import task_queues
 
 
 class BaseTestApp:
@@ -17,6 +20,10 @@ class BaseTestApp:
     def get_client(cls) -> AppClient:
         raise NotImplementedError
 
+    @classmethod
+    def get_app_config(cls) -> AppConfig:
+        pytest.skip("Needs to reconfigure the app")
+
     # fixtures
 
     @pytest_asyncio.fixture(scope="function")
@@ -31,6 +38,21 @@ class BaseTestApp:
             yield ws
         ws.close()
 
+    @pytest.fixture
+    def app_config(self) -> AppConfig:
+        return self.get_app_config()
+
+    @pytest_asyncio.fixture(scope="function")
+    async def stopped_runner(self, client):
+        # stop consuming tasks, so they stay queued (the next client starts a new runner)
+        runner_task = getattr(type(self), '_runner_task', None)
+        if runner_task is None:
+            pytest.skip("Needs to stop the app's runner")
+        runner_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await runner_task
+        type(self)._runner_task = None
+
     @pytest.fixture
     def common_params(self):
         return {
@@ -100,14 +122,14 @@ class BaseTestApp:
     async def assert_websocket_received(event_dict: dict[str, Any], websocket) -> dict[str, Any]:
         # blocks indefinitely until the event is received
         ws_event = json.loads(json.loads(await websocket.recv()))
-        assert ws_event == event_dict, ws_event
+        assert ws_event == {'event_id': mock.ANY} | event_dict, ws_event
         return ws_event
 
     @staticmethod
     async def assert_websocket_eventually_received(event_dict: dict[str, Any], websocket) -> dict[str, Any]:
         while True:
             ws_event = json.loads(json.loads(await websocket.recv()))
-            if ws_event == event_dict:
+            if ws_event == {'event_id': mock.ANY} | event_dict:
                 return ws_event
 
     async def assert_poll_status(self, client, task_id, expected_event) -> dict[str, Any]:
@@ -115,7 +137,7 @@ class BaseTestApp:
             response = await client.get(f'/task/{task_id}')
             assert response.status_code == 200
             event = response.json()
-            if event == expected_event:
+            if event == {'event_id': mock.ANY} | expected_event:
                 return event
             await asyncio.sleep(0.1)
 
@@ -144,6 +166,8 @@ class BaseTestApp:
             await self.assert_websocket_received({
                 'event_type': 'pending',
                 'task_id': task_id,
+                'queue_position': mock.ANY,
+                'eta': mock.ANY,
             }, websocket)
 
             # started event
@@ -158,6 +182,19 @@ class BaseTestApp:
         poll_event = await self.assert_poll_status(client, task_id, expected_event)
         return poll_event
 
+    @staticmethod
+    def count_queued_tasks(app_config: AppConfig) -> int:
+        messaging_repo = app_config.messaging_repo_class()
+        return sum(messaging_repo.queue_length(queue) for queue in task_queues)
+
+    async def assert_rejected(self, client, params: dict[str, Any], status_code: int, sync: bool = True) -> None:
+        responses = [await client.post('/task', json=params)]
+        if sync:
+            responses.append(await client.get('/txt2img', params=params))
+        for response in responses:
+            assert response.status_code == status_code, response.text
+            assert int(response.headers['Retry-After']) >= 1
+
     async def get_blob(self, client, blob_url: str) -> requests.Response:
         path = urllib.parse.urlparse(blob_url).path
         response = await client.get(path)
@@ -300,6 +337,23 @@ class BaseTestApp:
         generated_image = response.json()
         assert generated_image['parameters_used'] == resolved_dummy_txt2img_params
 
+    @pytest.mark.asyncio
+    async def test_queue_wait_metrics(
+        self,
+        client,
+        dummy_txt2img_params,
+    ):
+        response = await client.get('/txt2img', params=dummy_txt2img_params)
+        assert response.status_code == 200
+
+        response = await client.get('/metrics/queue_wait')
+        assert response.status_code == 200
+        histograms = response.json()
+        assert histograms.keys() == {'fifo', 'sjf'}
+        fifo = histograms['fifo']
+        assert fifo['count'] >= 1
+        assert sum(count for key, count in fifo.items() if key.startswith('le_')) == fifo['count']
+
     @pytest.mark.asyncio
     async def test_cancel_task(
         self,
@@ -320,6 +374,8 @@ class BaseTestApp:
         await self.assert_websocket_received({
             'event_type': 'pending',
             'task_id': task_id,
+            'queue_position': mock.ANY,
+            'eta': mock.ANY,
         }, websocket)
 
         await self.assert_websocket_received({
@@ -335,3 +391,117 @@ class BaseTestApp:
 
         await self.assert_websocket_received(aborted_event, websocket)
         await self.assert_poll_status(client, task_id, aborted_event)
+
+    @pytest.mark.asyncio
+    async def test_reject_task_over_user_queue_length(
+        self,
+        app_config,
+        monkeypatch,
+        client,
+        stopped_runner,
+        dummy_txt2img_params,
+    ):
+        await client.set_public_token()
+        response = await client.post('/task', json=dummy_txt2img_params)
+        assert response.status_code == 200
+        queued = self.count_queued_tasks(app_config)
+
+        monkeypatch.setattr(app_config, 'MAX_USER_QUEUE_LENGTH', 1)
+
+        await self.assert_rejected(client, dummy_txt2img_params, 429)
+        assert self.count_queued_tasks(app_config) == queued
+
+        await client.delete(f'/task/{response.json()}')
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('limit', ['MAX_QUEUE_LENGTH', 'MAX_ESTIMATED_WAIT'])
+    async def test_reject_task_over_queue_limits(
+        self,
+        app_config,
+        monkeypatch,
+        client,
+        stopped_runner,
+        dummy_txt2img_params,
+        limit,
+    ):
+        response = await client.post('/task', json=dummy_txt2img_params)
+        assert response.status_code == 200
+        queued = self.count_queued_tasks(app_config)
+
+        # full with the queued task, or any queued task takes too long
+        monkeypatch.setattr(app_config, limit, queued if limit == 'MAX_QUEUE_LENGTH' else 1e-9)
+        # synchronous tasks only wait for each other, so they're only rejected over the queue length
+        await self.assert_rejected(client, dummy_txt2img_params, 503, sync=limit == 'MAX_QUEUE_LENGTH')
+        assert self.count_queued_tasks(app_config) == queued
+
+        await client.delete(f'/task/{response.json()}')
+
+    @pytest.mark.asyncio
+    async def test_sync_request_timeout(
+        self,
+        app_config,
+        monkeypatch,
+        client,
+        stopped_runner,
+        dummy_txt2img_params,
+    ):
+        monkeypatch.setattr(app_config, 'SYNC_REQUEST_TIMEOUT', 0.5)
+        response = await client.get('/txt2img', params=dummy_txt2img_params)
+        assert response.status_code == 504, response.text
+
+    @pytest.mark.asyncio
+    async def test_task_aborted_after_deadline(
+        self,
+        client,
+        stopped_runner,
+        dummy_txt2img_params,
+    ):
+        response = await client.post('/task', params={'timeout': 0.2}, json=dummy_txt2img_params)
+        assert response.status_code == 200
+        task_id = response.json()
+        await asyncio.sleep(0.3)
+
+        # a new runner finds the task past its deadline
+        async with self.get_client() as runner_client:
+            runner_client.headers = client.headers
+            await asyncio.wait_for(self.assert_poll_status(runner_client, task_id, {
+                'event_type': 'aborted',
+                'task_id': task_id,
+                'reason': 'Task deadline passed before it started',
+            }), timeout=30)
+
+    @pytest.mark.asyncio
+    async def test_websocket_replays_missed_events(
+        self,
+        client,
+        dummy_txt2img_params,
+    ):
+        await client.set_public_token()
+        async with client.websocket_connect() as websocket:
+            response = await client.post('/task', json=dummy_txt2img_params)
+            assert response.status_code == 200
+            task_id = response.json()
+            pending_event = await self.assert_websocket_received({
+                'event_type': 'pending',
+                'task_id': task_id,
+                'queue_position': mock.ANY,
+                'eta': mock.ANY,
+            }, websocket)
+
+        finished_event = {
+            'event_type': 'finished',
+            'task_id': task_id,
+            'result': mock.ANY,
+        }
+        await self.assert_poll_status(client, task_id, finished_event)
+
+        # reconnect as the same session, from the last event received
+        async with self.get_client() as reconnected_client:
+            reconnected_client.set_token(client.headers['Authorization'].removeprefix('Bearer '))
+            reconnected_client.ws_stem += f'&last_event_id={pending_event["event_id"]}'
+            async with reconnected_client.websocket_connect() as websocket:
+                await self.assert_websocket_received({
+                    'event_type': 'started',
+                    'task_id': task_id,
+                }, websocket)
+                await self.assert_websocket_received(finished_event, websocket)
@@ -7,6 +7,7 @@ from asgi_lifespan import LifespanManager
 from stable_diffusion_api.api.tests.base import BaseTestApp
 
 from stable_diffusion_api.api.tests.utils import AsyncioTestClient, LocalAppClient
+from stable_diffusion_api.api import in_memory_app
 from stable_diffusion_api.api.in_memory_app import fastapi_app
 from stable_diffusion_api.engine.workers.in_memory_worker import create_runner
 
@@ -14,6 +15,10 @@ from stable_diffusion_api.engine.workers.in_memory_worker import create_runner
 class TestInMemoryApp(BaseTestApp):
     _runner_task = None
 
+    @classmethod
+    def get_app_config(cls):
+        return in_memory_app.app_config
+
     @classmethod
     def get_client(cls):
         loop = asyncio.get_event_loop()
@@ -25,6 +25,10 @@ except redis.exceptions.RedisError as e:
 class TestLiveRedisApp(BaseTestApp):
     _runner_task = None
 
+    @classmethod
+    def get_app_config(cls):
+        return redis_app.app_config
+
     @classmethod
     def get_client(cls):
         loop = asyncio.get_event_loop()
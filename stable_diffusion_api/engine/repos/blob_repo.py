@@ -7,7 +7,7 @@ from jose import jwt
 import jose.exceptions
 from typing_extensions import TypeAlias
 
-from stable_diffusion_api.engine.utils import get_redis
+from stable_diffusion_api.engine.utils import get_aioredis, get_redis
 from stable_diffusion_api.models.blob import BlobUrl, BlobId, BlobToken
 from stable_diffusion_api.models.user import Username
 import requests
@@ -61,6 +61,17 @@ class LocalBlobRepo(BlobRepo):
             return None
         return self._retrieve_blob(blob_id)
 
+    async def aput_blob(self, blob: bytes) -> BlobUrl:
+        blob_id = BlobId(uuid.uuid4())
+        await self._astore_blob(blob_id, blob)
+        return self.__make_url(blob_id)
+
+    async def aget_blob_by_token(self, blob_token: BlobToken) -> Optional[bytes]:
+        blob_id = self.__verify_token(blob_token)
+        if blob_id is None:
+            return None
+        return await self._aretrieve_blob(blob_id)
+
     def get_blob(self, blob_url: BlobUrl) -> Optional[bytes]:
         if not blob_url.startswith(self.base_blob_url):
             return super().get_blob(blob_url)
@@ -74,6 +85,14 @@ class LocalBlobRepo(BlobRepo):
     def _retrieve_blob(self, blob_id: BlobId) -> Optional[bytes]:
         raise NotImplementedError
 
+    # async variants for the API, so that round-trips don't block its event loop
+
+    async def _astore_blob(self, blob_id: BlobId, blob: bytes) -> None:
+        self._store_blob(blob_id, blob)
+
+    async def _aretrieve_blob(self, blob_id: BlobId) -> Optional[bytes]:
+        return self._retrieve_blob(blob_id)
+
 
 class InMemoryBlobRepo(LocalBlobRepo):
     _blobs = {}
@@ -89,6 +108,7 @@ class RedisBlobRepo(LocalBlobRepo):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.redis = get_redis()
+        self.aioredis = get_aioredis()
 
     def _store_blob(self, blob_id: BlobId, blob: bytes) -> None:
         self.redis.hset('blob_data', blob_id, blob)
@@ -98,3 +118,9 @@ class RedisBlobRepo(LocalBlobRepo):
         if data is None:
             return None
         return data
+
+    async def _astore_blob(self, blob_id: BlobId, blob: bytes) -> None:
+        await self.aioredis.hset('blob_data', blob_id, blob)
+
+    async def _aretrieve_blob(self, blob_id: BlobId) -> Optional[bytes]:
+        return await self.aioredis.hget('blob_data', blob_id)
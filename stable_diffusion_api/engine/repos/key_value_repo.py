@@ -1,7 +1,7 @@
 from collections import defaultdict
 from typing import Optional
 
-from stable_diffusion_api.engine.utils import get_redis
+from stable_diffusion_api.engine.utils import get_aioredis, get_redis
 
 
 class KeyValueRepo:
@@ -14,6 +14,29 @@ class KeyValueRepo:
     def exists(self, collection: str, key: str) -> bool:
         raise NotImplementedError
 
+    def delete(self, collection: str, key: str) -> None:
+        raise NotImplementedError
+
+    def increment(self, collection: str, key: str, amount: int = 1) -> int:
+        raise NotImplementedError
+
+    # async variants for the API, so that round-trips don't block its event loop
+
+    async def astore(self, collection: str, key: str, value: str) -> None:
+        self.store(collection, key, value)
+
+    async def aretrieve(self, collection: str, key: str) -> Optional[str]:
+        return self.retrieve(collection, key)
+
+    async def aexists(self, collection: str, key: str) -> bool:
+        return self.exists(collection, key)
+
+    async def adelete(self, collection: str, key: str) -> None:
+        self.delete(collection, key)
+
+    async def aincrement(self, collection: str, key: str, amount: int = 1) -> int:
+        return self.increment(collection, key, amount)
+
 
 class InMemoryKeyValueRepo(KeyValueRepo):
     _store = defaultdict(dict)
@@ -27,10 +50,19 @@ class InMemoryKeyValueRepo(KeyValueRepo):
     def exists(self, collection: str, key: str) -> bool:
         return key in self._store[collection]
 
+    def delete(self, collection: str, key: str) -> None:
+        self._store[collection].pop(key, None)
+
+    def increment(self, collection: str, key: str, amount: int = 1) -> int:
+        value = int(self._store[collection].get(key, 0)) + amount
+        self._store[collection][key] = str(value)
+        return value
+
 
 class RedisKeyValueRepo(KeyValueRepo):
     def __init__(self):
         self.redis = get_redis()
+        self.aioredis = get_aioredis()
 
     def store(self, collection: str, key: str, value: str) -> None:
         self.redis.hset(collection, key, value)
@@ -43,3 +75,27 @@ class RedisKeyValueRepo(KeyValueRepo):
 
     def exists(self, collection: str, key: str) -> bool:
         return self.redis.hexists(collection, key)
+
+    def delete(self, collection: str, key: str) -> None:
+        self.redis.hdel(collection, key)
+
+    def increment(self, collection: str, key: str, amount: int = 1) -> int:
+        return self.redis.hincrby(collection, key, amount)
+
+    async def astore(self, collection: str, key: str, value: str) -> None:
+        await self.aioredis.hset(collection, key, value)
+
+    async def aretrieve(self, collection: str, key: str) -> Optional[str]:
+        v = await self.aioredis.hget(collection, key)
+        if v is None:
+            return None
+        return v.decode('utf-8')
+
+    async def aexists(self, collection: str, key: str) -> bool:
+        return await self.aioredis.hexists(collection, key)
+
+    async def adelete(self, collection: str, key: str) -> None:
+        await self.aioredis.hdel(collection, key)
+
+    async def aincrement(self, collection: str, key: str, amount: int = 1) -> int:
+        return await self.aioredis.hincrby(collection, key, amount)
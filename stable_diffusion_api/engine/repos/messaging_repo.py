@@ -1,8 +1,16 @@
 import asyncio
+import bisect
+import itertools
+import json
 import logging
-from collections import defaultdict
-from datetime import datetime
-from typing import Sequence, Union, AsyncIterable, AsyncIterator
+import math
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import Sequence, Union, AsyncIterable, AsyncIterator, Optional
+
+import aioredis
+import redis
 
 from stable_diffusion_api.engine.utils import get_aioredis, get_redis
 
@@ -20,73 +28,605 @@ class MessagingRepo:
     async def subscribe(self, topic: str) -> None:
         raise NotImplementedError
 
+    async def unsubscribe(self, topic: str) -> None:
+        raise NotImplementedError
+
     async def listen(self) -> AsyncIterator[str]:
         raise NotImplementedError
         yield  # noqa, without this pyright can't tell that this is a generator, and can't wrap return type
 
+    ######
+    # Logs
+    ######
+
+    # logs keep the latest messages appended to them, so listeners that missed them can read them later
+
+    def append(self, log: str, message: str, max_length: int, ttl: float) -> str:
+        # returns the id of the message, ids increase within a log
+        # the log keeps about the latest max_length messages, and expires ttl seconds after the last append
+        raise NotImplementedError
+
+    def read_after(self, log: str, message_id: str) -> list[tuple[str, str]]:
+        # the ids and messages appended after the message with the given id, raises ValueError for malformed ids
+        raise NotImplementedError
+
     #######
     # Queue
     #######
 
-    def push(self, queue: str, message: str) -> None:
+    # messages are pushed into per-group sub-queues of a queue
+    # within each queue, pop takes turns between groups (round-robin)
+    # within each group, the message with the lowest score is popped first
+
+    def push(self, queue: str, message: str, group: str = '', score: Optional[float] = None) -> None:
+        # score defaults to the time of pushing, i.e. first in, first out
+        raise NotImplementedError
+
+    async def pop(self, queue: Union[str, Sequence[str]], consumer: Optional[str] = None) -> str:
+        # queues are popped in order of priority
+        # if a consumer is given, the message is held in flight until it's acknowledged,
+        # and redelivered if the consumer stops sending heartbeats before then
+        raise NotImplementedError
+
+    def queue_length(self, queue: str, group: Optional[str] = None) -> int:
+        # the length of a queue, or of one of its groups
+        raise NotImplementedError
+
+    def queue_rank(self, queue: str, group: str, score: float) -> int:
+        # the number of messages in a group with a lower score
         raise NotImplementedError
 
-    async def pop(self, queue: Union[str, Sequence[str]]) -> str:
+    def count_groups(self, queue: str) -> int:
+        # the number of groups with messages in a queue
         raise NotImplementedError
 
+    def group_offset(self, queue: str, group: str) -> Optional[int]:
+        # the number of groups whose turn comes before the group's, or None if the group has no messages
+        raise NotImplementedError
+
+    def ack(self, consumer: str, message: str) -> None:
+        raise NotImplementedError
+
+    def delivery_attempts(self, consumer: str, message: str) -> int:
+        # how many times an in-flight message was delivered, counting redeliveries after its consumers timed out
+        raise NotImplementedError
+
+    def heartbeat(self, consumer: str, timeout: float) -> None:
+        raise NotImplementedError
+
+    def recover(self) -> int:
+        # returns in-flight messages of consumers whose heartbeat timed out to the front of their groups
+        raise NotImplementedError
+
+    def count_consumers(self) -> int:
+        # the number of consumers whose heartbeat hasn't timed out
+        raise NotImplementedError
+
+    def claim_preemption(self, consumer: str, queue: str) -> bool:
+        # claims one of the messages waiting in a queue that no idle consumer of the queue is going to pop,
+        # the claim is released when the consumer pops again
+        raise NotImplementedError
+
+    # async variants for the API, so that round-trips don't block its event loop
+
+    async def apublish(self, topic: str, message: str) -> None:
+        self.publish(topic, message)
+
+    async def aappend(self, log: str, message: str, max_length: int, ttl: float) -> str:
+        return self.append(log, message, max_length, ttl)
+
+    async def aread_after(self, log: str, message_id: str) -> list[tuple[str, str]]:
+        return self.read_after(log, message_id)
+
+    async def apush(self, queue: str, message: str, group: str = '', score: Optional[float] = None) -> None:
+        self.push(queue, message, group=group, score=score)
+
+    async def aqueue_length(self, queue: str, group: Optional[str] = None) -> int:
+        return self.queue_length(queue, group=group)
+
+    async def aqueue_rank(self, queue: str, group: str, score: float) -> int:
+        return self.queue_rank(queue, group, score)
+
+    async def acount_groups(self, queue: str) -> int:
+        return self.count_groups(queue)
+
+    async def agroup_offset(self, queue: str, group: str) -> Optional[int]:
+        return self.group_offset(queue, group)
+
+    async def acount_consumers(self) -> int:
+        return self.count_consumers()
+
+
+class _Waiter:
+    # wakes a coroutine waiting on its event loop, from any thread
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def wake(self) -> None:
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self.loop is running_loop:
+            self.event.set()
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            # the waiter's loop was closed
+            pass
+
+
+class _Topic:
+    # keeps the latest messages of a topic, addressed by their absolute index
+
+    def __init__(self, capacity: int):
+        self.messages: deque[str] = deque(maxlen=capacity)
+        # absolute index of the next message
+        self.end = 0
+        self.listeners: set['InMemoryMessagingRepo'] = set()
+
+    @property
+    def start(self) -> int:
+        return self.end - len(self.messages)
+
+    def append(self, message: str) -> None:
+        self.messages.append(message)
+        self.end += 1
+
+    def read(self, cursor: int) -> list[str]:
+        # indexing near the end of a deque is O(1), so this is linear in the number of messages read
+        length = len(self.messages)
+        return [self.messages[i] for i in range(length - (self.end - cursor), length)]
+
+
+class _Group:
+    # the messages of a group in ascending order of (score, insertion order),
+    # in a list whose head moves forward on pop, so popping and ranking don't shift or walk the messages
+
+    def __init__(self):
+        self.entries: list[tuple[float, int, str]] = []
+        self.head = 0
+
+    def __len__(self) -> int:
+        return len(self.entries) - self.head
+
+    def add(self, entry: tuple[float, int, str]) -> None:
+        # messages mostly arrive in order (fifo), or at the front (requeued)
+        if self.head and entry < self.entries[self.head]:
+            self.head -= 1
+            self.entries[self.head] = entry
+        else:
+            bisect.insort(self.entries, entry, lo=self.head)
+
+    def popleft(self) -> tuple[float, int, str]:
+        entry = self.entries[self.head]
+        self.head += 1
+        # drop popped entries once they make up half the list, so pops stay amortized O(1)
+        if self.head * 2 >= len(self.entries):
+            del self.entries[:self.head]
+            self.head = 0
+        return entry
+
+    def rank(self, score: float) -> int:
+        return bisect.bisect_left(self.entries, (score,), lo=self.head) - self.head
+
+
+# the number of messages kept per topic for listeners that fall behind
+_in_memory_topic_capacity = 10000
+# topics exist while they have listeners, like in redis pubsub messages without listeners are dropped
+_in_memory_topics: dict[str, _Topic] = {}
+_in_memory_topics_lock = threading.RLock()
+
+# log -> (expiry time, (id, message) in order of appending), with logs in order of their last append
+_in_memory_logs: OrderedDict[str, tuple[float, deque[tuple[int, str]]]] = OrderedDict()
+_in_memory_log_ids = itertools.count(1)
+_in_memory_logs_lock = threading.Lock()
+
+# queue -> group -> messages, with groups in round-robin order
+_in_memory_queues: dict[str, dict[str, _Group]] = defaultdict(dict)
+_in_memory_insertion_order = itertools.count()
+# consumer -> message -> (queue, group, delivery attempts)
+_in_memory_in_flight: dict[str, dict[str, tuple[str, str, int]]] = defaultdict(dict)
+# queue -> redelivered message -> delivery attempts so far
+_in_memory_deliveries: dict[str, dict[str, int]] = defaultdict(dict)
+_in_memory_heartbeats: dict[str, float] = {}
+# queue -> consumers waiting for its messages, and consumers that claimed one of them to preempt their current one
+_in_memory_idle_consumers: dict[str, set[str]] = defaultdict(set)
+_in_memory_preempting_consumers: dict[str, set[str]] = defaultdict(set)
+# queues are also pushed to from the heartbeat thread, when recovering in-flight messages
+_in_memory_queues_lock = threading.RLock()
+# queue -> coroutines waiting for its messages in order of arrival, to the queues each of them pops
+_in_memory_queue_waiters: dict[str, dict[_Waiter, Sequence[str]]] = defaultdict(dict)
 
-_in_memory_topics: dict[str, list[tuple[datetime, str]]] = defaultdict(list)
-_in_memory_queues: dict[str, list[str]] = defaultdict(list)
+
+def _wake_queue_waiter(queue: str) -> None:
+    # wakes the longest waiting coroutine of a queue, so each push wakes one coroutine rather than all of them
+    with _in_memory_queues_lock:
+        waiters = _in_memory_queue_waiters.get(queue)
+        if not waiters:
+            return
+        waiter = next(iter(waiters))
+        # once woken, it doesn't take turns of the other queues it waits for
+        for q in waiters.pop(waiter):
+            _in_memory_queue_waiters[q].pop(waiter, None)
+    waiter.wake()
+
+
+def _hand_on_messages(queues: Sequence[str]) -> None:
+    # wakes another coroutine for each queue with messages left, in case this one was woken for them
+    for q in queues:
+        if _in_memory_queues[q]:
+            _wake_queue_waiter(q)
 
 
 class InMemoryMessagingRepo(MessagingRepo):
     def __init__(self):
-        self.subscribed_topics = set()
-        self.seen_topic_messages = set()
+        # topic -> absolute index of the next message to listen to
+        self.cursors: dict[str, int] = {}
+        # subscribed topics with messages that haven't been listened to yet
+        self.ready_topics: set[str] = set()
+        self.waiter: Optional[_Waiter] = None
 
-    def publish(self, topic: str, message: str) -> None:
-        _in_memory_topics[topic].append((datetime.now(), message))
+    def _wake(self, topic: str) -> None:
+        with _in_memory_topics_lock:
+            self.ready_topics.add(topic)
+            waiter = self.waiter
+        if waiter is not None:
+            waiter.wake()
 
-        # def timed_remove():
-        #     time.sleep(1)
-        #     if message in _in_memory_topics[topic]:
-        #         _in_memory_topics[topic].remove(message)
-        # threading.Thread(target=timed_remove).start()
+    def publish(self, topic: str, message: str) -> None:
+        # only the topic's own listeners are woken
+        with _in_memory_topics_lock:
+            in_memory_topic = _in_memory_topics.get(topic)
+            if in_memory_topic is None:
+                return
+            in_memory_topic.append(message)
+            listeners = list(in_memory_topic.listeners)
+        for listener in listeners:
+            listener._wake(topic)
 
     async def subscribe(self, topic: str) -> None:
-        self.subscribed_topics.add(topic)
+        # like redis pubsub, only listen to messages published from now on
+        with _in_memory_topics_lock:
+            in_memory_topic = _in_memory_topics.get(topic)
+            if in_memory_topic is None:
+                in_memory_topic = _in_memory_topics[topic] = _Topic(_in_memory_topic_capacity)
+            self.cursors.setdefault(topic, in_memory_topic.end)
+            in_memory_topic.listeners.add(self)
+
+    async def unsubscribe(self, topic: str) -> None:
+        with _in_memory_topics_lock:
+            self.cursors.pop(topic, None)
+            self.ready_topics.discard(topic)
+            in_memory_topic = _in_memory_topics.get(topic)
+            if in_memory_topic is None:
+                return
+            in_memory_topic.listeners.discard(self)
+            if not in_memory_topic.listeners:
+                del _in_memory_topics[topic]
+
+    def _read_topics(self) -> list[str]:
+        messages = []
+        for topic in self.ready_topics:
+            in_memory_topic = _in_memory_topics[topic]
+            cursor = self.cursors[topic]
+            if cursor < in_memory_topic.start:
+                logger.warning(f'Listener fell behind on {topic}, skipped {in_memory_topic.start - cursor} messages')
+                cursor = in_memory_topic.start
+            messages.extend(in_memory_topic.read(cursor))
+            self.cursors[topic] = in_memory_topic.end
+        self.ready_topics.clear()
+        return messages
 
     async def listen(self) -> AsyncIterator[str]:
-        displayed = defaultdict(list)
-        while True:
-            for topic in self.subscribed_topics:
-                for message in _in_memory_topics[topic]:
-                    if message not in displayed[topic]:
-                        _, payload = message
-                        yield payload
-                        displayed[topic].append(message)
-            await asyncio.sleep(0.1)
-
-    def push(self, queue: str, message: str) -> None:
-        _in_memory_queues[queue].append(message)
-
-    async def pop(self, queue: Union[str, Sequence[str]]) -> str:
+        self.waiter = _Waiter()
+        try:
+            while True:
+                with _in_memory_topics_lock:
+                    messages = self._read_topics()
+                    if not messages:
+                        # cleared while holding the lock, so a message published in between still wakes it
+                        self.waiter.event.clear()
+                if not messages:
+                    await self.waiter.event.wait()
+                    continue
+                for message in messages:
+                    yield message
+        finally:
+            self.waiter = None
+
+    def append(self, log: str, message: str, max_length: int, ttl: float) -> str:
+        now = time.monotonic()
+        with _in_memory_logs_lock:
+            _, messages = _in_memory_logs.pop(log, (now, None))
+            if messages is None or messages.maxlen != max_length:
+                messages = deque(messages or (), maxlen=max_length)
+            message_id = next(_in_memory_log_ids)
+            messages.append((message_id, message))
+            _in_memory_logs[log] = (now + ttl, messages)
+            # logs share their ttl, so they expire in order of their last append, from the front
+            while True:
+                expires_at, _ = next(iter(_in_memory_logs.values()))
+                if expires_at > now:
+                    break
+                _in_memory_logs.popitem(last=False)
+        return str(message_id)
+
+    def read_after(self, log: str, message_id: str) -> list[tuple[str, str]]:
+        after = int(message_id)
+        with _in_memory_logs_lock:
+            expires_at, messages = _in_memory_logs.get(log, (0, ()))
+            if expires_at <= time.monotonic():
+                return []
+            # linear in the number of messages read
+            entries = []
+            for entry_id, message in reversed(messages):
+                if entry_id <= after:
+                    break
+                entries.append((str(entry_id), message))
+        return entries[::-1]
+
+    def push(self, queue: str, message: str, group: str = '', score: Optional[float] = None) -> None:
+        if score is None:
+            score = time.time()
+        entry = (score, next(_in_memory_insertion_order), message)
+        with _in_memory_queues_lock:
+            # a new group joins at the end of the round
+            _in_memory_queues[queue].setdefault(group, _Group()).add(entry)
+            _wake_queue_waiter(queue)
+
+    def _pop(self, queues: Sequence[str], consumer: Optional[str]) -> Optional[str]:
+        with _in_memory_queues_lock:
+            for q in queues:
+                groups = _in_memory_queues[q]
+                if not groups:
+                    continue
+                # take the group whose turn it is, and move it to the end of the round
+                group = next(iter(groups))
+                messages = groups.pop(group)
+                _, _, message = messages.popleft()
+                if messages:
+                    groups[group] = messages
+                attempts = _in_memory_deliveries[q].pop(message, 0) + 1
+                if consumer is not None:
+                    _in_memory_in_flight[consumer][message] = (q, group, attempts)
+                    for popped_queue in queues:
+                        _in_memory_idle_consumers[popped_queue].discard(consumer)
+                        _in_memory_preempting_consumers[popped_queue].discard(consumer)
+                return message
+            if consumer is not None:
+                for popped_queue in queues:
+                    _in_memory_idle_consumers[popped_queue].add(consumer)
+        return None
+
+    async def pop(self, queue: Union[str, Sequence[str]], consumer: Optional[str] = None) -> str:
         queues = [queue] if isinstance(queue, str) else queue
         while True:
-            if not any(_in_memory_queues[q] for q in queues):
-                await asyncio.sleep(0.1)
-                continue
-            for q in queues:
-                if _in_memory_queues[q]:
-                    return _in_memory_queues[q].pop(0)
-            await asyncio.sleep(0.1)
+            with _in_memory_queues_lock:
+                message = self._pop(queues, consumer)
+                if message is None:
+                    # register while holding the lock, so a push in between isn't missed
+                    waiter = _Waiter()
+                    for q in queues:
+                        _in_memory_queue_waiters[q][waiter] = queues
+            if message is not None:
+                # this one may have taken a message from another queue than the one it was woken for
+                _hand_on_messages(queues)
+                return message
+            cancelled = True
+            try:
+                await waiter.event.wait()
+                cancelled = False
+            finally:
+                with _in_memory_queues_lock:
+                    for q in queues:
+                        _in_memory_queue_waiters[q].pop(waiter, None)
+                        if not _in_memory_queue_waiters[q]:
+                            del _in_memory_queue_waiters[q]
+                # don't take a wake up along when cancelled
+                if cancelled:
+                    _hand_on_messages(queues)
+
+    def queue_length(self, queue: str, group: Optional[str] = None) -> int:
+        with _in_memory_queues_lock:
+            if group is not None:
+                return len(_in_memory_queues[queue].get(group, ()))
+            return sum(len(messages) for messages in _in_memory_queues[queue].values())
+
+    def queue_rank(self, queue: str, group: str, score: float) -> int:
+        with _in_memory_queues_lock:
+            messages = _in_memory_queues[queue].get(group)
+            return 0 if messages is None else messages.rank(score)
+
+    def count_groups(self, queue: str) -> int:
+        return len(_in_memory_queues[queue])
+
+    def group_offset(self, queue: str, group: str) -> Optional[int]:
+        # linear in the number of groups, like LPOS
+        with _in_memory_queues_lock:
+            groups = _in_memory_queues[queue]
+            if group not in groups:
+                return None
+            return list(groups).index(group)
+
+    def ack(self, consumer: str, message: str) -> None:
+        with _in_memory_queues_lock:
+            _in_memory_in_flight[consumer].pop(message, None)
+
+    def delivery_attempts(self, consumer: str, message: str) -> int:
+        with _in_memory_queues_lock:
+            _, _, attempts = _in_memory_in_flight[consumer].get(message, ('', '', 1))
+            return attempts
+
+    def heartbeat(self, consumer: str, timeout: float) -> None:
+        _in_memory_heartbeats[consumer] = time.monotonic() + timeout
+
+    def recover(self) -> int:
+        recovered = 0
+        now = time.monotonic()
+        with _in_memory_queues_lock:
+            for consumer, expires_at in list(_in_memory_heartbeats.items()):
+                if expires_at > now:
+                    continue
+                for message, (queue, group, attempts) in _in_memory_in_flight.pop(consumer, {}).items():
+                    _in_memory_deliveries[queue][message] = attempts
+                    self.push(queue, message, group=group, score=-math.inf)
+                    recovered += 1
+                del _in_memory_heartbeats[consumer]
+        return recovered
+
+    def count_consumers(self) -> int:
+        now = time.monotonic()
+        return sum(1 for expires_at in list(_in_memory_heartbeats.values()) if expires_at > now)
+
+    def claim_preemption(self, consumer: str, queue: str) -> bool:
+        now = time.monotonic()
+        with _in_memory_queues_lock:
+            idle, preempting = _in_memory_idle_consumers[queue], _in_memory_preempting_consumers[queue]
+            # forget consumers whose heartbeat timed out
+            for consumers in [idle, preempting]:
+                consumers.difference_update(
+                    [c for c in consumers if _in_memory_heartbeats.get(c, -math.inf) <= now]
+                )
+            if self.queue_length(queue) - len(idle) - len(preempting) <= 0:
+                return False
+            preempting.add(consumer)
+            return True
+
+
+# a queue is made up of:
+# - `<queue>:group:<group>`, a sorted set of messages per group, popped lowest score first
+# - `<queue>:groups`, a list of groups with messages, rotated right to left to take turns
+# - `<queue>:length`, the total number of messages
+# - `<queue>:signal`, a list that consumers block on to wake up when messages are pushed
+# - `<queue>:deliveries`, a hash of how many times redelivered messages were delivered before
+# and consumers are tracked in:
+# - `consumers`, a set of consumers that sent heartbeats, each with a `heartbeat:<consumer>` key until it times out
+# - `in_flight:<consumer>`, a hash of the messages a consumer popped, but didn't acknowledge yet,
+#   to their queue, group and delivery attempts
+# - `<queue>:idle`, a set of consumers waiting for messages of a queue
+# - `<queue>:preempting`, a set of consumers that claimed a message of a queue to preempt their current one for
+_push_function = """
+local function push(queue, group, message, score, max_signals)
+    local group_key = queue .. ':group:' .. group
+    if redis.call('ZADD', group_key, score, message) == 0 then
+        return
+    end
+    -- a new group joins at the end of the round
+    if redis.call('ZCARD', group_key) == 1 then
+        redis.call('LPUSH', queue .. ':groups', group)
+    end
+    redis.call('INCR', queue .. ':length')
+    redis.call('LPUSH', queue .. ':signal', '')
+    redis.call('LTRIM', queue .. ':signal', 0, max_signals - 1)
+end
+"""
+
+# ARGV: queue, group, message, score, max signals
+_push_script = _push_function + """
+push(ARGV[1], ARGV[2], ARGV[3], ARGV[4], tonumber(ARGV[5]))
+"""
+
+# pops the first message from a list of queues, and optionally records it in the consumer's in-flight hash
+# KEYS: optionally, the in-flight hash; ARGV: the consumer, queues in order of priority
+_pop_script = """
+local consumer = ARGV[1]
+for i = 2, #ARGV do
+    local queue = ARGV[i]
+    local groups_key = queue .. ':groups'
+    local group = redis.call('RPOPLPUSH', groups_key, groups_key)
+    while group do
+        local group_key = queue .. ':group:' .. group
+        local message = redis.call('ZPOPMIN', group_key)[1]
+        if redis.call('ZCARD', group_key) == 0 then
+            redis.call('LPOP', groups_key)
+        end
+        if message then
+            redis.call('DECR', queue .. ':length')
+            local deliveries_key = queue .. ':deliveries'
+            local attempts = tonumber(redis.call('HGET', deliveries_key, message) or 0) + 1
+            redis.call('HDEL', deliveries_key, message)
+            if #KEYS > 0 then
+                redis.call('HSET', KEYS[1], message, cjson.encode({queue, group, attempts}))
+                for j = 2, #ARGV do
+                    redis.call('SREM', ARGV[j] .. ':idle', consumer)
+                    redis.call('SREM', ARGV[j] .. ':preempting', consumer)
+                end
+            end
+            return message
+        end
+        group = redis.call('RPOPLPUSH', groups_key, groups_key)
+    end
+end
+if #KEYS > 0 then
+    for i = 2, #ARGV do
+        redis.call('SADD', ARGV[i] .. ':idle', consumer)
+    end
+end
+return false
+"""
+
+# claims a message waiting in a queue, if there are more of them than idle and preempting consumers of the queue
+# ARGV: the consumer, the queue
+_claim_preemption_script = """
+local queue = ARGV[2]
+local available = 0
+for _, key in ipairs({queue .. ':idle', queue .. ':preempting'}) do
+    for _, consumer in ipairs(redis.call('SMEMBERS', key)) do
+        -- forget consumers whose heartbeat timed out
+        if redis.call('EXISTS', 'heartbeat:' .. consumer) == 1 then
+            available = available + 1
+        else
+            redis.call('SREM', key, consumer)
+        end
+    end
+end
+if tonumber(redis.call('GET', queue .. ':length') or 0) - available <= 0 then
+    return 0
+end
+redis.call('SADD', queue .. ':preempting', ARGV[1])
+return 1
+"""
+
+# returns all messages from an in-flight hash to the front of the groups they were popped from
+# KEYS: the in-flight hash; ARGV: max signals
+_recover_in_flight_script = _push_function + """
+local entries = redis.call('HGETALL', KEYS[1])
+for i = 1, #entries, 2 do
+    local origin = cjson.decode(entries[i + 1])
+    redis.call('HSET', origin[1] .. ':deliveries', entries[i], origin[3] or 1)
+    push(origin[1], origin[2], entries[i], '-inf', tonumber(ARGV[1]))
+end
+redis.call('DEL', KEYS[1])
+return #entries / 2
+"""
 
 
 class RedisMessagingRepo(MessagingRepo):
+    # the number of pending wake-up signals kept per queue
+    max_signals = 100
+
     def __init__(self):
         self.redis = get_redis()
         self.aioredis = get_aioredis()
         self.pubsub = self.aioredis.pubsub()
+        self.subscribed = asyncio.Event()
+        self.push_script = self.redis.register_script(_push_script)
+        self.apush_script = self.aioredis.register_script(_push_script)
+        self.pop_script = self.aioredis.register_script(_pop_script)
+        self.recover_in_flight_script = self.redis.register_script(_recover_in_flight_script)
+        self.claim_preemption_script = self.redis.register_script(_claim_preemption_script)
+
+    @staticmethod
+    def _in_flight_key(consumer: str) -> str:
+        return f'in_flight:{consumer}'
+
+    @staticmethod
+    def _heartbeat_key(consumer: str) -> str:
+        return f'heartbeat:{consumer}'
 
     def publish(self, topic: str, message: str) -> None:
         num = self.redis.publish(topic, message)
@@ -95,19 +635,165 @@ class RedisMessagingRepo(MessagingRepo):
     async def subscribe(self, topic: str) -> None:
         logger.debug(f'Subscribing to topic: {topic}')
         await self.pubsub.subscribe(topic)
+        self.subscribed.set()
+
+    async def unsubscribe(self, topic: str) -> None:
+        logger.debug(f'Unsubscribing from topic: {topic}')
+        await self.pubsub.unsubscribe(topic)
 
     async def listen(self) -> AsyncIterator[str]:
-        async for message in self.pubsub.listen():
-            if message is None:
-                continue
-            data = message['data']
-            if data == 1:
+        while True:
+            # the pubsub stops listening while it isn't subscribed to any topic
+            await self.subscribed.wait()
+            async for message in self.pubsub.listen():
+                if message is None or message['type'] != 'message':
+                    continue
+                yield message['data']
+            if not self.pubsub.subscribed:
+                self.subscribed.clear()
+
+    def append(self, log: str, message: str, max_length: int, ttl: float) -> str:
+        # a stream trimmed approximately, which redis does in whole nodes
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xadd(log, {'message': message}, maxlen=max_length, approximate=True)
+        pipe.pexpire(log, int(ttl * 1000))
+        message_id, _ = pipe.execute()
+        return message_id.decode('utf-8')
+
+    def read_after(self, log: str, message_id: str) -> list[tuple[str, str]]:
+        try:
+            entries = self.redis.xrange(log, min=f'({message_id}')
+        except redis.exceptions.ResponseError as e:
+            raise ValueError(f'Invalid message id: {message_id}') from e
+        return [(entry_id.decode('utf-8'), fields[b'message'].decode('utf-8')) for entry_id, fields in entries]
+
+    def push(self, queue: str, message: str, group: str = '', score: Optional[float] = None) -> None:
+        if score is None:
+            score = time.time()
+        self.push_script(args=[queue, group, message, repr(score), self.max_signals])
+
+    async def pop(self, queue: Union[str, Sequence[str]], consumer: Optional[str] = None) -> str:
+        queues = [queue] if isinstance(queue, str) else list(queue)
+        keys = [] if consumer is None else [self._in_flight_key(consumer)]
+
+        # taking turns between groups (and moving the message into the in-flight hash) needs a script,
+        # so pop with it, and block on the queues' signals while they're empty
+        while True:
+            message = await self.pop_script(keys=keys, args=[consumer or '', *queues])
+            if message is not None:
+                return message
+            await self.aioredis.brpop([f'{q}:signal' for q in queues], timeout=1)
+
+    def queue_length(self, queue: str, group: Optional[str] = None) -> int:
+        if group is not None:
+            return self.redis.zcard(f'{queue}:group:{group}')
+        length = self.redis.get(f'{queue}:length')
+        if length is None:
+            return 0
+        return int(length)
+
+    def queue_rank(self, queue: str, group: str, score: float) -> int:
+        return self.redis.zcount(f'{queue}:group:{group}', '-inf', f'({score!r}')
+
+    def count_groups(self, queue: str) -> int:
+        return self.redis.llen(f'{queue}:groups')
+
+    def group_offset(self, queue: str, group: str) -> Optional[int]:
+        # groups take turns from the right end of the list
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lpos(f'{queue}:groups', group)
+        pipe.llen(f'{queue}:groups')
+        index, length = pipe.execute()
+        if index is None:
+            return None
+        return length - 1 - index
+
+    def ack(self, consumer: str, message: str) -> None:
+        self.redis.hdel(self._in_flight_key(consumer), message)
+
+    def delivery_attempts(self, consumer: str, message: str) -> int:
+        entry = self.redis.hget(self._in_flight_key(consumer), message)
+        if entry is None:
+            return 1
+        origin = json.loads(entry)
+        return origin[2] if len(origin) > 2 else 1
+
+    def heartbeat(self, consumer: str, timeout: float) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self._heartbeat_key(consumer), '', px=int(timeout * 1000))
+        pipe.sadd('consumers', consumer)
+        pipe.execute()
+
+    def recover(self) -> int:
+        recovered = 0
+        for consumer in self.redis.smembers('consumers'):
+            consumer = consumer.decode('utf-8')
+            if self.redis.exists(self._heartbeat_key(consumer)):
                 continue
-            yield data
+            num = self.recover_in_flight_script(keys=[self._in_flight_key(consumer)], args=[self.max_signals])
+            if num:
+                logger.warning(f'Redelivered {num} messages of unresponsive consumer {consumer}')
+            recovered += num
+            self.redis.srem('consumers', consumer)
+        return recovered
+
+    def count_consumers(self) -> int:
+        consumers = [consumer.decode('utf-8') for consumer in self.redis.smembers('consumers')]
+        if not consumers:
+            return 0
+        return self.redis.exists(*[self._heartbeat_key(consumer) for consumer in consumers])
+
+    def claim_preemption(self, consumer: str, queue: str) -> bool:
+        return bool(self.claim_preemption_script(args=[consumer, queue]))
+
+    async def apublish(self, topic: str, message: str) -> None:
+        num = await self.aioredis.publish(topic, message)
+        logger.debug(f'Published message to {topic} for {num} subscribers')
+
+    async def aappend(self, log: str, message: str, max_length: int, ttl: float) -> str:
+        pipe = self.aioredis.pipeline(transaction=False)
+        pipe.xadd(log, {'message': message}, maxlen=max_length, approximate=True)
+        pipe.pexpire(log, int(ttl * 1000))
+        message_id, _ = await pipe.execute()
+        return message_id.decode('utf-8')
+
+    async def aread_after(self, log: str, message_id: str) -> list[tuple[str, str]]:
+        try:
+            entries = await self.aioredis.xrange(log, min=f'({message_id}')
+        except aioredis.exceptions.ResponseError as e:
+            raise ValueError(f'Invalid message id: {message_id}') from e
+        return [(entry_id.decode('utf-8'), fields[b'message'].decode('utf-8')) for entry_id, fields in entries]
+
+    async def apush(self, queue: str, message: str, group: str = '', score: Optional[float] = None) -> None:
+        if score is None:
+            score = time.time()
+        await self.apush_script(args=[queue, group, message, repr(score), self.max_signals])
+
+    async def aqueue_length(self, queue: str, group: Optional[str] = None) -> int:
+        if group is not None:
+            return await self.aioredis.zcard(f'{queue}:group:{group}')
+        length = await self.aioredis.get(f'{queue}:length')
+        if length is None:
+            return 0
+        return int(length)
+
+    async def aqueue_rank(self, queue: str, group: str, score: float) -> int:
+        return await self.aioredis.zcount(f'{queue}:group:{group}', '-inf', f'({score!r}')
+
+    async def acount_groups(self, queue: str) -> int:
+        return await self.aioredis.llen(f'{queue}:groups')
 
-    def push(self, queue: str, message: str) -> None:
-        self.redis.lpush(queue, message)
+    async def agroup_offset(self, queue: str, group: str) -> Optional[int]:
+        pipe = self.aioredis.pipeline(transaction=False)
+        pipe.lpos(f'{queue}:groups', group)
+        pipe.llen(f'{queue}:groups')
+        index, length = await pipe.execute()
+        if index is None:
+            return None
+        return length - 1 - index
 
-    async def pop(self, queue: Union[str, Sequence[str]]) -> str:
-        _, message = await self.aioredis.brpop(queue)
-        return message
+    async def acount_consumers(self) -> int:
+        consumers = [consumer.decode('utf-8') for consumer in await self.aioredis.smembers('consumers')]
+        if not consumers:
+            return 0
+        return await self.aioredis.exists(*[self._heartbeat_key(consumer) for consumer in consumers])
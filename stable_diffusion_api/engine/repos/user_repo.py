@@ -6,7 +6,7 @@ import jose
 from jose import jwt
 from passlib.context import CryptContext
 
-from stable_diffusion_api.engine.utils import get_redis
+from stable_diffusion_api.engine.utils import get_aioredis, get_redis
 from stable_diffusion_api.models.user import Username, UserInDB, DefaultUsername, UserBase, AuthenticationError, \
     AuthToken, User
 
@@ -39,35 +39,25 @@ class UserRepo:
     #         raise AuthenticationError("Invalid password")
     #     return User(**user_in_db.dict())
 
-    def create_user(self, user: UserBase, password: str) -> None:
-        if not self.allow_public_token and user.username == DefaultUsername:
+    async def _aget_user_by_username(self, username: Username) -> Optional[UserInDB]:
+        return self._get_user_by_username(username)
+
+    async def _aput_user(self, user: UserInDB) -> None:
+        self._put_user(user)
+
+    def _check_username(self, username: Username) -> None:
+        if not self.allow_public_token and username == DefaultUsername:
             raise AuthenticationError("Invalid username")
 
-        if self._get_user_by_username(user.username) is not None:
+    def _make_user_in_db(self, user: UserBase, password: str, existing_user: Optional[UserInDB]) -> UserInDB:
+        if existing_user is not None:
             raise AuthenticationError(f"User {user.username} already exists")
-        self._put_user(UserInDB(
+        return UserInDB(
             hashed_password=self.pwd_context.hash(password),
             **user.dict(),
-        ))
-
-    def create_public_token(self) -> AuthToken:
-        if not self.allow_public_token:
-            raise RuntimeError("Public token is not allowed")
-
-        user_in_db = self._get_user_by_username(DefaultUsername)
-        if user_in_db is None:
-            # default user's password is insecure; the other functions explicitly disallow login with it when disabled
-            self.create_user(UserBase(username=DefaultUsername), password="password")
-        try:
-            return self.create_token_by_username_and_password(DefaultUsername, "password")
-        except AuthenticationError:
-            raise RuntimeError(f"Failed to create default token as User 'all'")
-
-    def create_token_by_username_and_password(self, username: Username, password: str) -> AuthToken:
-        if not self.allow_public_token and username == DefaultUsername:
-            raise AuthenticationError("Invalid username")
+        )
 
-        user_in_db = self._get_user_by_username(username)
+    def _make_token(self, username: Username, password: str, user_in_db: Optional[UserInDB]) -> AuthToken:
         if user_in_db is None:
             raise AuthenticationError(f"User {username} does not exist")
         if not self.pwd_context.verify(password, user_in_db.hashed_password):
@@ -83,7 +73,8 @@ class UserRepo:
         token_string = jwt.encode(data, self.secret_key, algorithm=self.algorithm)
         return AuthToken(access_token=token_string, token_type="bearer")
 
-    def must_get_user_by_token(self, token: str) -> User:
+    def _decode_token(self, token: str) -> tuple[Username, str]:
+        # returns the token's username and session id
         try:
             payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
         except jose.JWTError:
@@ -108,8 +99,10 @@ class UserRepo:
             self.secret_key,
             algorithm=self.algorithm
         )
+        return username, session_id
 
-        user_in_db = self._get_user_by_username(username)
+    @staticmethod
+    def _make_user(user_in_db: Optional[UserInDB], session_id: str) -> User:
         if user_in_db is None:
             raise AuthenticationError("Invalid token")
         return User(
@@ -117,6 +110,57 @@ class UserRepo:
             session_id=session_id,
         )
 
+    def create_user(self, user: UserBase, password: str) -> None:
+        self._check_username(user.username)
+        self._put_user(self._make_user_in_db(user, password, self._get_user_by_username(user.username)))
+
+    def create_public_token(self) -> AuthToken:
+        if not self.allow_public_token:
+            raise RuntimeError("Public token is not allowed")
+
+        user_in_db = self._get_user_by_username(DefaultUsername)
+        if user_in_db is None:
+            # default user's password is insecure; the other functions explicitly disallow login with it when disabled
+            self.create_user(UserBase(username=DefaultUsername), password="password")
+        try:
+            return self.create_token_by_username_and_password(DefaultUsername, "password")
+        except AuthenticationError:
+            raise RuntimeError(f"Failed to create default token as User 'all'")
+
+    def create_token_by_username_and_password(self, username: Username, password: str) -> AuthToken:
+        self._check_username(username)
+        return self._make_token(username, password, self._get_user_by_username(username))
+
+    def must_get_user_by_token(self, token: str) -> User:
+        username, session_id = self._decode_token(token)
+        return self._make_user(self._get_user_by_username(username), session_id)
+
+    # async variants for the API, so that round-trips don't block its event loop
+
+    async def acreate_user(self, user: UserBase, password: str) -> None:
+        self._check_username(user.username)
+        await self._aput_user(self._make_user_in_db(user, password, await self._aget_user_by_username(user.username)))
+
+    async def acreate_public_token(self) -> AuthToken:
+        if not self.allow_public_token:
+            raise RuntimeError("Public token is not allowed")
+
+        user_in_db = await self._aget_user_by_username(DefaultUsername)
+        if user_in_db is None:
+            await self.acreate_user(UserBase(username=DefaultUsername), password="password")
+        try:
+            return await self.acreate_token_by_username_and_password(DefaultUsername, "password")
+        except AuthenticationError:
+            raise RuntimeError(f"Failed to create default token as User 'all'")
+
+    async def acreate_token_by_username_and_password(self, username: Username, password: str) -> AuthToken:
+        self._check_username(username)
+        return self._make_token(username, password, await self._aget_user_by_username(username))
+
+    async def amust_get_user_by_token(self, token: str) -> User:
+        username, session_id = self._decode_token(token)
+        return self._make_user(await self._aget_user_by_username(username), session_id)
+
 
 class InMemoryUserRepo(UserRepo):
     _in_memory_users = {}
@@ -132,6 +176,7 @@ class RedisUserRepo(UserRepo):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.redis = get_redis()
+        self.aioredis = get_aioredis()
 
     def _get_user_by_username(self, username: Username) -> Optional[UserInDB]:
         json_user = self.redis.hget('user', username)
@@ -141,3 +186,12 @@ class RedisUserRepo(UserRepo):
 
     def _put_user(self, user: UserInDB) -> None:
         self.redis.hset('user', user.username, user.json())
+
+    async def _aget_user_by_username(self, username: Username) -> Optional[UserInDB]:
+        json_user = await self.aioredis.hget('user', username)
+        if json_user is None:
+            return None
+        return UserInDB.parse_raw(json_user)
+
+    async def _aput_user(self, user: UserInDB) -> None:
+        await self.aioredis.hset('user', user.username, user.json())
@@ -1,4 +1,5 @@
 import logging
+from collections import defaultdict
 from typing import AsyncIterator, Optional
 
 import pydantic
@@ -14,21 +15,68 @@ from stable_diffusion_api.models.user import SessionId
 logger = logging.getLogger(__name__)
 
 
+def get_session_topic(session_id: SessionId) -> str:
+    return f'event:{session_id}'
+
+
+def get_session_log(session_id: SessionId) -> str:
+    return f'event_log:{session_id}'
+
+
 class EventService:
     def __init__(
         self,
         messaging_repo: MessagingRepo,
         status_service: StatusService,
+        event_log_length: int = 100,
+        event_log_ttl: float = 24 * 60 * 60,
     ):
         self.messaging_repo = messaging_repo
         self.status_service = status_service
+        self.event_log_length = event_log_length
+        self.event_log_ttl = event_log_ttl
 
     def send_event(self, session_id: SessionId, event: EventUnion):
+        # log the event, so clients that reconnect can catch up on the events they missed
+        event_id = self.messaging_repo.append(
+            get_session_log(session_id),
+            _serialize_message(session_id, event),
+            self.event_log_length,
+            self.event_log_ttl,
+        )
+        event = event.copy(update={'event_id': event_id})
         # store latest task event
         self.status_service.store_event(event)
         # serialize and push session_id + event
         msg = _serialize_message(session_id, event)
-        self.messaging_repo.publish('event', msg)
+        self.messaging_repo.publish(get_session_topic(session_id), msg)
+
+    async def asend_event(self, session_id: SessionId, event: EventUnion):
+        # async variant for the API, so that round-trips don't block its event loop
+        event_id = await self.messaging_repo.aappend(
+            get_session_log(session_id),
+            _serialize_message(session_id, event),
+            self.event_log_length,
+            self.event_log_ttl,
+        )
+        event = event.copy(update={'event_id': event_id})
+        await self.status_service.astore_event(event)
+        await self.messaging_repo.apublish(get_session_topic(session_id), _serialize_message(session_id, event))
+
+    @staticmethod
+    def _parse_logged_events(entries: list[tuple[str, str]]) -> list[EventUnion]:
+        events = []
+        for logged_id, msg in entries:
+            _, event = _deserialize_message(msg, EventUnion)
+            events.append(event.copy(update={'event_id': logged_id}))
+        return events
+
+    def get_events_after(self, session_id: SessionId, event_id: str) -> list[EventUnion]:
+        # the session's logged events sent after the given one, raises ValueError for malformed ids
+        return self._parse_logged_events(self.messaging_repo.read_after(get_session_log(session_id), event_id))
+
+    async def aget_events_after(self, session_id: SessionId, event_id: str) -> list[EventUnion]:
+        return self._parse_logged_events(await self.messaging_repo.aread_after(get_session_log(session_id), event_id))
 
 
 class EventListener:
@@ -37,9 +85,19 @@ class EventListener:
         messaging_repo: MessagingRepo,
     ):
         self.messaging_repo = messaging_repo
+        # a session's topic is subscribed to while the session has subscribers
+        self.session_subscribers: dict[SessionId, int] = defaultdict(int)
+
+    async def subscribe_session(self, session_id: SessionId) -> None:
+        self.session_subscribers[session_id] += 1
+        if self.session_subscribers[session_id] == 1:
+            await self.messaging_repo.subscribe(get_session_topic(session_id))
 
-    async def initialize(self):
-        await self.messaging_repo.subscribe('event')
+    async def unsubscribe_session(self, session_id: SessionId) -> None:
+        self.session_subscribers[session_id] -= 1
+        if self.session_subscribers[session_id] == 0:
+            del self.session_subscribers[session_id]
+            await self.messaging_repo.unsubscribe(get_session_topic(session_id))
 
     async def listen(self) -> AsyncIterator[tuple[SessionId, EventUnion]]:
         async for data in self.messaging_repo.listen():
@@ -0,0 +1,101 @@
+import asyncio
+import math
+from typing import Optional
+
+from stable_diffusion_api.engine.repos.key_value_repo import KeyValueRepo
+from stable_diffusion_api.models.params import Params
+from stable_diffusion_api.models.task import SchedulingPolicy
+
+# upper bounds of the queue wait histogram buckets, in seconds
+queue_wait_buckets = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, math.inf]
+
+
+class MetricsService:
+    # weight of the latest measurement in a model's rolling throughput
+    throughput_smoothing = 0.2
+    # assumed for models whose throughput hasn't been measured yet
+    default_seconds_per_cost = 1.0
+    # assumed until any task's duration has been measured, about a default txt2img task
+    default_task_seconds = 20.0
+
+    def __init__(
+        self,
+        key_value_repo: KeyValueRepo,
+    ):
+        self.key_value_repo = key_value_repo
+
+    def _get_measured_seconds_per_cost(self, model: str) -> Optional[float]:
+        seconds_per_cost = self.key_value_repo.retrieve('model_throughput', model)
+        if seconds_per_cost is None:
+            return None
+        return float(seconds_per_cost)
+
+    async def _aget_measured_seconds_per_cost(self, model: str) -> Optional[float]:
+        seconds_per_cost = await self.key_value_repo.aretrieve('model_throughput', model)
+        if seconds_per_cost is None:
+            return None
+        return float(seconds_per_cost)
+
+    def _update_average(self, collection: str, key: str, value: float) -> None:
+        previous = self.key_value_repo.retrieve(collection, key)
+        if previous is not None:
+            value = (1 - self.throughput_smoothing) * float(previous) + self.throughput_smoothing * value
+        self.key_value_repo.store(collection, key, str(value))
+
+    def record_throughput(self, model: str, cost: float, seconds: float) -> None:
+        if cost <= 0:
+            return
+        self._update_average('model_throughput', model, seconds / cost)
+        self._update_average('task_duration', 'average', seconds)
+
+    def get_seconds_per_cost(self, model: str) -> float:
+        seconds_per_cost = self._get_measured_seconds_per_cost(model)
+        if seconds_per_cost is None:
+            return self.default_seconds_per_cost
+        return seconds_per_cost
+
+    async def aget_seconds_per_cost(self, model: str) -> float:
+        seconds_per_cost = await self._aget_measured_seconds_per_cost(model)
+        if seconds_per_cost is None:
+            return self.default_seconds_per_cost
+        return seconds_per_cost
+
+    def estimate_task_seconds(self, params: Params) -> float:
+        return params.cost() * self.get_seconds_per_cost(params.model)
+
+    async def aestimate_task_seconds(self, params: Params) -> float:
+        return params.cost() * await self.aget_seconds_per_cost(params.model)
+
+    def get_average_task_seconds(self) -> float:
+        # across all models, for estimating how long queued tasks take to drain
+        seconds = self.key_value_repo.retrieve('task_duration', 'average')
+        if seconds is None:
+            return self.default_task_seconds
+        return float(seconds)
+
+    async def aget_average_task_seconds(self) -> float:
+        seconds = await self.key_value_repo.aretrieve('task_duration', 'average')
+        if seconds is None:
+            return self.default_task_seconds
+        return float(seconds)
+
+    def record_queue_wait(self, policy: SchedulingPolicy, seconds: float) -> None:
+        collection = f'queue_wait:{policy}'
+        bucket = next(b for b in queue_wait_buckets if seconds <= b)
+        self.key_value_repo.increment(collection, f'le_{bucket}')
+        self.key_value_repo.increment(collection, 'count')
+        self.key_value_repo.increment(collection, 'sum_ms', int(seconds * 1000))
+
+    def get_queue_wait_histogram(self, policy: SchedulingPolicy) -> dict[str, int]:
+        collection = f'queue_wait:{policy}'
+        keys = [f'le_{b}' for b in queue_wait_buckets] + ['count', 'sum_ms']
+        return {
+            key: int(self.key_value_repo.retrieve(collection, key) or 0)
+            for key in keys
+        }
+
+    async def aget_queue_wait_histogram(self, policy: SchedulingPolicy) -> dict[str, int]:
+        collection = f'queue_wait:{policy}'
+        keys = [f'le_{b}' for b in queue_wait_buckets] + ['count', 'sum_ms']
+        values = await asyncio.gather(*[self.key_value_repo.aretrieve(collection, key) for key in keys])
+        return {key: int(value or 0) for key, value in zip(keys, values)}
@@ -1,6 +1,7 @@
 import io
 import logging
 import os
+import time
 from typing import Any, Optional
 
 import PIL.Image
@@ -11,7 +12,9 @@ from diffusers import StableDiffusionPipeline, DDIMScheduler, LMSDiscreteSchedul
 
 from stable_diffusion_api.engine.repos.blob_repo import BlobRepo
 from stable_diffusion_api.engine.services.event_service import EventService
+from stable_diffusion_api.engine.services.metrics_service import MetricsService
 from stable_diffusion_api.engine.services.status_service import StatusService
+from stable_diffusion_api.engine.services.task_service import TaskService
 from stable_diffusion_api.models.blob import BlobUrl
 from stable_diffusion_api.models.events import FinishedEvent, StartedEvent, AbortedEvent
 from stable_diffusion_api.models.params import Txt2ImgParams, Img2ImgParams, InpaintParams, Params
@@ -26,16 +29,59 @@ class TaskCancelledException(Exception):
     pass
 
 
+class TaskPreemptedException(Exception):
+    pass
+
+
+class ResumedScheduler:
+    """
+    Stands in for a pipeline's scheduler to continue a checkpointed run.
+    Restores the checkpointed scheduler state when the pipeline sets timesteps,
+    and hides the timesteps that already ran from the pipeline's denoising loop.
+    """
+
+    def __init__(self, scheduler, state: dict[str, Any], start_step: int):
+        self._scheduler = scheduler
+        self._state = state
+        self._start_step = start_step
+
+    def set_timesteps(self, *args, **kwargs):
+        self._scheduler.set_timesteps(*args, **kwargs)
+        self._scheduler.__dict__.update(self._state)
+
+    @property
+    def timesteps(self):
+        return self._scheduler.timesteps[self._start_step:]
+
+    @property
+    def init_noise_sigma(self):
+        # checkpointed latents are already scaled
+        return 1.0
+
+    def __getattr__(self, name):
+        return getattr(self._scheduler, name)
+
+
 class RunnerService:
     def __init__(
         self,
         blob_repo: BlobRepo,
         status_service: StatusService,
         event_service: EventService,
+        task_service: TaskService,
+        metrics_service: MetricsService,
+        checkpoint_interval: int = 0,
+        max_delivery_attempts: int = 0,
     ):
         self.blob_repo = blob_repo
         self.status_service = status_service
         self.event_service = event_service
+        self.task_service = task_service
+        self.metrics_service = metrics_service
+        # checkpoint every `checkpoint_interval` steps, so a redelivered task can resume (0 disables)
+        self.checkpoint_interval = checkpoint_interval
+        # abort a task once it was delivered to this many workers that died before finishing it (0 disables)
+        self.max_delivery_attempts = max_delivery_attempts
 
         self.cached_kwargs: Optional[dict[str, Any]] = None
         self.cached_pipeline = None
@@ -63,15 +109,75 @@ class RunnerService:
 
     def pipeline_callback(
         self,
-        task_id: TaskId,
+        task: Task,
+        consumer: Optional[str],
+        pipe: DiffusionPipeline,
+        generator: torch.Generator,
+        start_step: int,
         step: int,
         timestep: int,
         latents: torch.FloatTensor,
     ):
-        if self.status_service.is_task_cancelled(task_id):
+        if self.status_service.is_task_cancelled(task.task_id):
             raise TaskCancelledException()
         # TODO update progress and save intermediate results
 
+        if not self.is_preemptible(task):
+            return
+        next_step = start_step + step + 1
+
+        # yield to higher priority tasks, resuming from the next step later
+        if consumer is not None and self.task_service.claim_preemption(consumer, task.priority):
+            self.store_checkpoint(task, pipe, generator, next_step, latents)
+            raise TaskPreemptedException()
+
+        # periodically checkpoint, in case this worker dies before finishing the task
+        if self.checkpoint_interval and next_step % self.checkpoint_interval == 0:
+            self.store_checkpoint(task, pipe, generator, next_step, latents)
+
+    def is_preemptible(self, task: Task) -> bool:
+        # only txt2img accepts initial latents, which is what a run is resumed from
+        return isinstance(task.parameters, Txt2ImgParams)
+
+    def store_checkpoint(
+        self,
+        task: Task,
+        pipe: DiffusionPipeline,
+        generator: torch.Generator,
+        next_step: int,
+        latents: torch.FloatTensor,
+    ) -> None:
+        scheduler = pipe.scheduler
+        if isinstance(scheduler, ResumedScheduler):
+            scheduler = scheduler._scheduler
+        checkpoint = io.BytesIO()
+        torch.save({
+            'seed': task.parameters.seed,
+            'step': next_step,
+            'latents': latents,
+            'scheduler_state': {k: v for k, v in scheduler.__dict__.items() if k != '_internal_dict'},
+            'generator_state': generator.get_state(),
+        }, checkpoint)
+        self.status_service.store_checkpoint(task.task_id, checkpoint.getvalue())
+
+    def load_checkpoint(self, task: Task, device: str) -> Optional[dict[str, Any]]:
+        if not self.is_preemptible(task):
+            return None
+        checkpoint = self.status_service.get_checkpoint(task.task_id)
+        if checkpoint is None:
+            return None
+        try:
+            checkpoint = torch.load(io.BytesIO(checkpoint), map_location=device)
+            missing_keys = {'seed', 'step', 'latents', 'scheduler_state', 'generator_state'} - checkpoint.keys()
+            if missing_keys:
+                raise ValueError(f'Checkpoint is missing {missing_keys}')
+        except Exception:
+            # restart the task from scratch, rather than failing it on every delivery
+            logger.warning(f'Discard unreadable checkpoint of task {task.task_id}', exc_info=True)
+            self.status_service.delete_checkpoint(task.task_id)
+            return None
+        return checkpoint
+
     def get_arguments(self, task: Task, device: str) -> tuple[dict[str, Any], dict[str, Any], Optional[str]]:
         params = task.parameters
 
@@ -164,9 +270,43 @@ class RunnerService:
             parameters_used=task.parameters,
         )
 
-    async def run_task(self, task: Task) -> None:
+    async def run_task(self, task: Task, consumer: Optional[str] = None, delivery_attempts: int = 1) -> None:
+        # the consumer that popped the task, which may yield it to higher priority tasks
         logger.info(f'Handle task: {task}')
 
+        # a task may be delivered again if its worker died before acknowledging it
+        if isinstance(self.status_service.get_latest_event(task.task_id), (FinishedEvent, AbortedEvent)):
+            logger.info(f'Skip task that already ended: {task}')
+            return
+
+        # don't spend a generation on a result nobody waits for anymore,
+        # but finish tasks that started in time and yielded to higher priority tasks
+        if task.is_expired() and self.status_service.get_checkpoint(task.task_id) is None:
+            logger.info(f'Drop task past its deadline: {task}')
+            self.event_service.send_event(
+                task.user.session_id,
+                AbortedEvent(
+                    event_type="aborted",
+                    task_id=task.task_id,
+                    reason="Task deadline passed before it started",
+                )
+            )
+            return
+
+        # don't let a task that kills its workers take down every worker in turn
+        if self.max_delivery_attempts and delivery_attempts > self.max_delivery_attempts:
+            logger.error(f'Drop task delivered {delivery_attempts} times: {task}')
+            self.status_service.delete_checkpoint(task.task_id)
+            self.event_service.send_event(
+                task.user.session_id,
+                AbortedEvent(
+                    event_type="aborted",
+                    task_id=task.task_id,
+                    reason=f"Task failed on {delivery_attempts - 1} workers",
+                )
+            )
+            return
+
         # started event
         self.event_service.send_event(
             task.user.session_id,
@@ -179,10 +319,25 @@ class RunnerService:
         # pick device
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
-        # extract parameters
-        pipeline_kwargs, pipe_kwargs, pipe_method_name = self.get_arguments(task, device)
-
         try:
+            # resume from a checkpoint, if the task was preempted or its previous worker died
+            checkpoint = self.load_checkpoint(task, device)
+            if checkpoint is not None:
+                task.parameters.seed = checkpoint['seed']
+            else:
+                # first run of the task, measure how long it waited to be dispatched
+                self.metrics_service.record_queue_wait(task.scheduling_policy, time.time() - task.created_at)
+
+            # extract parameters
+            pipeline_kwargs, pipe_kwargs, pipe_method_name = self.get_arguments(task, device)
+            generator = pipe_kwargs['generator']
+
+            start_step = 0
+            if checkpoint is not None:
+                start_step = checkpoint['step']
+                pipe_kwargs['latents'] = checkpoint['latents']
+                generator.set_state(checkpoint['generator_state'].cpu())
+
             # create or reuse pipeline
             if self.cached_pipeline is not None and self.cached_kwargs == pipeline_kwargs:
                 # reuse cached pipeline
@@ -200,16 +355,38 @@ class RunnerService:
             else:
                 pipe_method = getattr(pipe, pipe_method_name)
 
+            scheduler = pipe.scheduler
+            if checkpoint is not None:
+                pipe.scheduler = ResumedScheduler(scheduler, checkpoint['scheduler_state'], start_step)
+
             # run pipeline
-            output = pipe_method(
-                **pipe_kwargs,
-                callback=lambda step, timestep, latents: self.pipeline_callback(task.task_id, step, timestep, latents)
+            started_at = time.monotonic()
+            try:
+                output = pipe_method(
+                    **pipe_kwargs,
+                    callback=lambda step, timestep, latents: self.pipeline_callback(
+                        task, consumer, pipe, generator, start_step, step, timestep, latents
+                    )
+                )
+            finally:
+                pipe.scheduler = scheduler
+
+            # measure the model's throughput, on the part of the task that was run
+            self.metrics_service.record_throughput(
+                task.parameters.model,
+                task.parameters.cost() * max(1 - start_step / task.parameters.steps, 0),
+                time.monotonic() - started_at,
             )
 
             # get output
             img = output.images[0]
+        except TaskPreemptedException:
+            logger.info(f'Task preempted by higher priority task: {task}')
+            self.task_service.requeue_task(task)
+            return
         except TaskCancelledException:
             logger.info(f'Task cancelled by user: {task}')
+            self.status_service.delete_checkpoint(task.task_id)
             self.event_service.send_event(
                 task.user.session_id,
                 AbortedEvent(
@@ -221,6 +398,7 @@ class RunnerService:
             return
         except Exception as e:
             logger.error(f'Error while handling task: {task}', exc_info=True)
+            self.status_service.delete_checkpoint(task.task_id)
             self.event_service.send_event(
                 task.user.session_id,
                 AbortedEvent(
@@ -233,6 +411,7 @@ class RunnerService:
 
         # save image
         generated_image = self.save_img(img, task)
+        self.status_service.delete_checkpoint(task.task_id)
 
         # finished event
         self.event_service.send_event(
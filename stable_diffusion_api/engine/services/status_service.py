@@ -1,3 +1,4 @@
+import base64
 from typing import Optional
 
 import pydantic
@@ -44,3 +45,43 @@ class StatusService:
 
     def is_task_cancelled(self, task_id: TaskId) -> bool:
         return self.key_value_repo.exists('task_cancelled', task_id)
+
+    def store_checkpoint(self, task_id: TaskId, checkpoint: bytes) -> None:
+        self.key_value_repo.store('task_checkpoint', task_id, base64.b64encode(checkpoint).decode('ascii'))
+
+    def get_checkpoint(self, task_id: TaskId) -> Optional[bytes]:
+        checkpoint = self.key_value_repo.retrieve('task_checkpoint', task_id)
+        if checkpoint is None:
+            return None
+        return base64.b64decode(checkpoint)
+
+    def delete_checkpoint(self, task_id: TaskId) -> None:
+        self.key_value_repo.delete('task_checkpoint', task_id)
+
+    # async variants for the API, so that round-trips don't block its event loop
+
+    async def astore_task(self, task: Task) -> None:
+        await self.key_value_repo.astore('task', task.task_id, task.json())
+
+    async def aget_task(self, task_id: TaskId) -> Optional[Task]:
+        task_json = await self.key_value_repo.aretrieve('task', task_id)
+        if task_json is None:
+            return None
+        return pydantic.parse_raw_as(Task, task_json)
+
+    async def astore_event(self, event: EventUnion) -> None:
+        if not await self.key_value_repo.aexists('task', event.task_id):
+            raise ValueError(f"Task {event.task_id} does not exist")
+        await self.key_value_repo.astore('task_event', event.task_id, event.json())
+
+    async def aget_latest_event(self, task_id: TaskId) -> Optional[EventUnion]:
+        event_json = await self.key_value_repo.aretrieve('task_event', task_id)
+        if event_json is None:
+            return None
+        return pydantic.parse_raw_as(EventUnion, event_json)
+
+    async def acancel_task(self, task_id: TaskId) -> None:
+        task = await self.aget_task(task_id)
+        if task is None:
+            raise ValueError(f"Task {task_id} does not exist")
+        await self.key_value_repo.astore('task_cancelled', task_id, 'true')
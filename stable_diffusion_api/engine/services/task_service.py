@@ -1,53 +1,356 @@
+import asyncio
 import logging
-from typing import AsyncIterator
+import math
+import os
+import socket
+import typing
+import uuid
+from typing import AsyncIterator, Optional, Union
 
 import pydantic
 
 from stable_diffusion_api.engine.repos.messaging_repo import MessagingRepo
 from stable_diffusion_api.engine.services.event_service import EventService
+from stable_diffusion_api.engine.services.metrics_service import MetricsService
 from stable_diffusion_api.engine.services.status_service import StatusService
 from stable_diffusion_api.models.events import PendingEvent
-from stable_diffusion_api.models.task import Task
+from stable_diffusion_api.models.task import Task, TaskPriority, SchedulingPolicy
+from stable_diffusion_api.models.user import DefaultUsername
 
 logger = logging.getLogger(__name__)
 
 
+def get_task_queue(priority: TaskPriority) -> str:
+    return f'task_queue:{priority}'
+
+
+# queues ordered from highest to lowest priority
+task_queues = [get_task_queue(priority) for priority in typing.get_args(TaskPriority)]
+
+
+def get_task_group(task: Task) -> str:
+    # tasks are dispatched taking turns between users, and between the sessions of the shared public user
+    if task.user.username == DefaultUsername:
+        return f'{DefaultUsername}:{task.user.session_id}'
+    return task.user.username
+
+
+class TaskRejectedException(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        # seconds until the task would likely be admitted
+        self.retry_after = retry_after
+
+
+class QueueFullException(TaskRejectedException):
+    pass
+
+
+class UserQueueFullException(TaskRejectedException):
+    pass
+
+
 class TaskService:
     def __init__(
         self,
         messaging_repo: MessagingRepo,
         event_service: EventService,
         status_service: StatusService,
+        metrics_service: MetricsService,
+        scheduling_policy: SchedulingPolicy = "fifo",
+        sjf_aging_factor: float = 10,
+        max_queue_length: int = 0,
+        max_user_queue_length: int = 0,
+        max_estimated_wait: float = 0,
     ):
         self.messaging_repo = messaging_repo
         self.event_service = event_service
         self.status_service = status_service
+        self.metrics_service = metrics_service
+        self.scheduling_policy = scheduling_policy
+        # under sjf, a task is passed over by cheaper tasks for at most `sjf_aging_factor` times its estimated duration
+        self.sjf_aging_factor = sjf_aging_factor
+        # admission limits (0 disables)
+        self.max_queue_length = max_queue_length
+        self.max_user_queue_length = max_user_queue_length
+        self.max_estimated_wait = max_estimated_wait
+
+    def _get_score(self, task: Task, estimated_task_seconds: float) -> float:
+        # tasks of a user are dispatched lowest score first
+        score = task.created_at
+        if task.scheduling_policy == "sjf":
+            score += self.sjf_aging_factor * estimated_task_seconds
+        return score
+
+    def get_score(self, task: Task) -> float:
+        if task.scheduling_policy != "sjf":
+            return self._get_score(task, 0)
+        return self._get_score(task, self.metrics_service.estimate_task_seconds(task.parameters))
+
+    async def aget_score(self, task: Task) -> float:
+        if task.scheduling_policy != "sjf":
+            return self._get_score(task, 0)
+        return self._get_score(task, await self.metrics_service.aestimate_task_seconds(task.parameters))
+
+    @staticmethod
+    def _get_drain_seconds(num_tasks: int, average_task_seconds: float, num_workers: int) -> float:
+        # how long the workers currently alive take to run a number of tasks
+        return num_tasks * average_task_seconds / max(num_workers, 1)
+
+    def get_drain_seconds(self, num_tasks: int) -> float:
+        return self._get_drain_seconds(
+            num_tasks,
+            self.metrics_service.get_average_task_seconds(),
+            self.messaging_repo.count_consumers(),
+        )
+
+    async def aget_drain_seconds(self, num_tasks: int) -> float:
+        average_task_seconds, num_workers = await asyncio.gather(
+            self.metrics_service.aget_average_task_seconds(),
+            self.messaging_repo.acount_consumers(),
+        )
+        return self._get_drain_seconds(num_tasks, average_task_seconds, num_workers)
+
+    def _has_admission_limits(self) -> bool:
+        return bool(self.max_user_queue_length or self.max_queue_length or self.max_estimated_wait)
+
+    def _check_admission(
+        self,
+        task: Task,
+        user_queue_lengths: list[int],
+        queue_lengths: list[int],
+        average_task_seconds: float,
+        num_workers: int,
+    ) -> None:
+        # queue lengths are listed in the order of `task_queues`
+        if self.max_user_queue_length:
+            user_queue_length = sum(user_queue_lengths)
+            if user_queue_length >= self.max_user_queue_length:
+                raise UserQueueFullException(
+                    "Too many queued tasks for this user",
+                    # the user's tasks are run one at a time, taking turns with other users
+                    (user_queue_length - self.max_user_queue_length + 1) * average_task_seconds,
+                )
+
+        queue_length = sum(queue_lengths)
+        if self.max_queue_length and queue_length >= self.max_queue_length:
+            raise QueueFullException(
+                "Task queue is full",
+                self._get_drain_seconds(queue_length - self.max_queue_length + 1, average_task_seconds, num_workers),
+            )
+
+        # the task waits for tasks of its own and higher priorities
+        tasks_ahead = 0
+        for queue, length in zip(task_queues, queue_lengths):
+            tasks_ahead += length
+            if queue == get_task_queue(task.priority):
+                break
+        estimated_wait = self._get_drain_seconds(tasks_ahead, average_task_seconds, num_workers)
+        if self.max_estimated_wait and estimated_wait > self.max_estimated_wait:
+            raise QueueFullException(
+                "Estimated wait is too long",
+                estimated_wait - self.max_estimated_wait,
+            )
+
+    def check_admission(self, task: Task) -> None:
+        # shed load before queueing a task that would wait too long, or make the queues grow without bound
+        if not self._has_admission_limits():
+            return
+        self._check_admission(
+            task,
+            [self.messaging_repo.queue_length(queue, group=get_task_group(task)) for queue in task_queues],
+            [self.messaging_repo.queue_length(queue) for queue in task_queues],
+            self.metrics_service.get_average_task_seconds(),
+            self.messaging_repo.count_consumers(),
+        )
+
+    async def acheck_admission(self, task: Task) -> None:
+        if not self._has_admission_limits():
+            return
+        user_queue_lengths, queue_lengths, average_task_seconds, num_workers = await asyncio.gather(
+            asyncio.gather(*[
+                self.messaging_repo.aqueue_length(queue, group=get_task_group(task)) for queue in task_queues
+            ]),
+            asyncio.gather(*[self.messaging_repo.aqueue_length(queue) for queue in task_queues]),
+            self.metrics_service.aget_average_task_seconds(),
+            self.messaging_repo.acount_consumers(),
+        )
+        self._check_admission(task, list(user_queue_lengths), list(queue_lengths), average_task_seconds, num_workers)
+
+    @staticmethod
+    def _get_queue_position(
+        task: Task,
+        queue_lengths: list[int],
+        rank: int,
+        groups: int,
+        offset: Optional[int],
+        queued: bool,
+    ) -> int:
+        # rank, groups and offset are of the task's group in its own queue
+        position = 0
+        for queue, length in zip(task_queues, queue_lengths):
+            if queue != get_task_queue(task.priority):
+                # tasks of higher priority are started first
+                position += length
+                continue
+            if offset is None:
+                # a new group joins at the end of the round
+                offset, groups = groups, groups + 1
+            # users take turns, so about one task of every other user is started per task of this user ahead,
+            # plus one of each user whose turn comes first
+            others = length - (1 if queued else 0)
+            position += max(min(rank * groups + offset, others), 0)
+            break
+        return position
+
+    def estimate_queue_position(self, task: Task, queued: bool = True) -> int:
+        # only counts, without walking the queues, so it's cheap enough to recompute on every poll
+        queue, group = get_task_queue(task.priority), get_task_group(task)
+        return self._get_queue_position(
+            task,
+            [self.messaging_repo.queue_length(q) for q in task_queues],
+            0 if task.queue_score is None else self.messaging_repo.queue_rank(queue, group, task.queue_score),
+            self.messaging_repo.count_groups(queue),
+            self.messaging_repo.group_offset(queue, group),
+            queued,
+        )
+
+    async def aestimate_queue_position(self, task: Task, queued: bool = True) -> int:
+        queue, group = get_task_queue(task.priority), get_task_group(task)
+
+        async def get_rank() -> int:
+            if task.queue_score is None:
+                return 0
+            return await self.messaging_repo.aqueue_rank(queue, group, task.queue_score)
+
+        queue_lengths, rank, groups, offset = await asyncio.gather(
+            asyncio.gather(*[self.messaging_repo.aqueue_length(q) for q in task_queues]),
+            get_rank(),
+            self.messaging_repo.acount_groups(queue),
+            self.messaging_repo.agroup_offset(queue, group),
+        )
+        return self._get_queue_position(task, list(queue_lengths), rank, groups, offset, queued)
+
+    def get_pending_event(self, task: Task, queued: bool = True) -> PendingEvent:
+        queue_position = self.estimate_queue_position(task, queued=queued)
+        return PendingEvent(
+            event_type="pending",
+            task_id=task.task_id,
+            queue_position=queue_position,
+            eta=self.get_drain_seconds(queue_position) + self.metrics_service.estimate_task_seconds(task.parameters),
+        )
+
+    async def aget_pending_event(self, task: Task, queued: bool = True) -> PendingEvent:
+        queue_position = await self.aestimate_queue_position(task, queued=queued)
+        drain_seconds, task_seconds = await asyncio.gather(
+            self.aget_drain_seconds(queue_position),
+            self.metrics_service.aestimate_task_seconds(task.parameters),
+        )
+        return PendingEvent(
+            event_type="pending",
+            task_id=task.task_id,
+            queue_position=queue_position,
+            eta=drain_seconds + task_seconds,
+        )
 
     def push_task(self, task: Task) -> None:
+        self.check_admission(task)
+        task.scheduling_policy = self.scheduling_policy
+        task.queue_score = self.get_score(task)
         # register task
         self.status_service.store_task(task)
         # advertise task pending status
         self.event_service.send_event(
             task.user.session_id,
-            PendingEvent(
-                event_type="pending",
-                task_id=task.task_id,
-            )
+            self.get_pending_event(task, queued=False),
+        )
+        # push task, taking turns between users of the same priority
+        self.messaging_repo.push(
+            get_task_queue(task.priority),
+            task.json(),
+            group=get_task_group(task),
+            score=task.queue_score,
         )
-        # push task
-        self.messaging_repo.push('task_queue', task.json())
+
+    async def apush_task(self, task: Task) -> None:
+        # async variant for the API, so that round-trips don't block its event loop
+        await self.acheck_admission(task)
+        task.scheduling_policy = self.scheduling_policy
+        task.queue_score = await self.aget_score(task)
+        await self.status_service.astore_task(task)
+        await self.event_service.asend_event(
+            task.user.session_id,
+            await self.aget_pending_event(task, queued=False),
+        )
+        await self.messaging_repo.apush(
+            get_task_queue(task.priority),
+            task.json(),
+            group=get_task_group(task),
+            score=task.queue_score,
+        )
+
+    def requeue_task(self, task: Task) -> None:
+        task.queue_score = None
+        self.status_service.store_task(task)
+        # advertise task pending status again
+        self.event_service.send_event(
+            task.user.session_id,
+            self.get_pending_event(task, queued=False),
+        )
+        # push task to the front of its user's queue, so it resumes before the user's other tasks
+        self.messaging_repo.push(
+            get_task_queue(task.priority),
+            task.json(),
+            group=get_task_group(task),
+            score=-math.inf,
+        )
+
+    def claim_preemption(self, consumer: str, priority: TaskPriority) -> bool:
+        # a higher priority task preempts a running task only if no idle worker is going to pick it up,
+        # and only one worker yields per waiting higher priority task
+        for queue in task_queues:
+            if queue == get_task_queue(priority):
+                return False
+            if self.messaging_repo.claim_preemption(consumer, queue):
+                return True
+        return False
 
 
 class TaskListener:
     def __init__(
         self,
         messaging_repo: MessagingRepo,
+        heartbeat_timeout: float = 60,
     ):
         self.messaging_repo = messaging_repo
+        self.heartbeat_timeout = heartbeat_timeout
+
+        # popped tasks are held in flight under this consumer until acknowledged
+        self.consumer = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.in_flight: dict[str, Union[str, bytes]] = {}
+
+    def heartbeat(self) -> None:
+        # keep this listener's tasks in flight, and redeliver tasks of listeners that stopped responding
+        self.messaging_repo.heartbeat(self.consumer, self.heartbeat_timeout)
+        self.messaging_repo.recover()
 
     async def get_task(self) -> Task:
-        task_json = await self.messaging_repo.pop('task_queue')
-        return Task.parse_raw(task_json)
+        task_json = await self.messaging_repo.pop(task_queues, consumer=self.consumer)
+        task = Task.parse_raw(task_json)
+        self.in_flight[task.task_id] = task_json
+        return task
+
+    def get_delivery_attempts(self, task: Task) -> int:
+        task_json = self.in_flight.get(task.task_id)
+        if task_json is None:
+            return 1
+        return self.messaging_repo.delivery_attempts(self.consumer, task_json)
+
+    def ack_task(self, task: Task) -> None:
+        task_json = self.in_flight.pop(task.task_id, None)
+        if task_json is not None:
+            self.messaging_repo.ack(self.consumer, task_json)
 
     async def listen(self) -> AsyncIterator[Task]:
         while True:
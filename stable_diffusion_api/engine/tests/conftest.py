@@ -0,0 +1,49 @@
+import uuid
+
+import pytest
+import redis
+
+from stable_diffusion_api.engine.repos.key_value_repo import InMemoryKeyValueRepo, RedisKeyValueRepo
+from stable_diffusion_api.engine.repos.messaging_repo import InMemoryMessagingRepo, RedisMessagingRepo
+from stable_diffusion_api.engine.utils import load_redis
+from stable_diffusion_api.models.params import Txt2ImgParams
+from stable_diffusion_api.models.task import Task
+from stable_diffusion_api.models.user import User
+
+
+def skip_without_redis():
+    try:
+        load_redis()
+    except redis.exceptions.RedisError:
+        pytest.skip("Could not connect to redis instance, skipping redis tests")
+
+
+@pytest.fixture(params=['in_memory', 'redis'])
+def repo_backend(request) -> str:
+    if request.param == 'redis':
+        skip_without_redis()
+    return request.param
+
+
+@pytest.fixture
+def messaging_repo_class(repo_backend):
+    return {'in_memory': InMemoryMessagingRepo, 'redis': RedisMessagingRepo}[repo_backend]
+
+
+@pytest.fixture
+def key_value_repo_class(repo_backend):
+    return {'in_memory': InMemoryKeyValueRepo, 'redis': RedisKeyValueRepo}[repo_backend]
+
+
+@pytest.fixture
+def queue():
+    # repos share state between tests, so each test gets its own queue
+    return f'test_queue:{uuid.uuid4()}'
+
+
+def make_task(username: str = 'user', **kwargs) -> Task:
+    return Task(
+        parameters=Txt2ImgParams(prompt='corgi', steps=2),
+        user=User(username=username, session_id=f'{username}:{uuid.uuid4()}'),
+        **kwargs,
+    )
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+from pydantic import parse_obj_as
+
+from stable_diffusion_api.engine.services.event_service import EventListener, EventService
+from stable_diffusion_api.engine.services.status_service import StatusService
+from stable_diffusion_api.engine.tests.conftest import make_task
+from stable_diffusion_api.models.events import EventUnion, PendingEvent
+
+
+@pytest.mark.asyncio
+async def test_listener_only_receives_subscribed_sessions(messaging_repo_class, key_value_repo_class):
+    status_service = StatusService(key_value_repo_class())
+    event_service = EventService(messaging_repo_class(), status_service)
+
+    # two app replicas, each holding a different session
+    task_a, task_b = make_task('a'), make_task('b')
+    listener_a = EventListener(messaging_repo_class())
+    listener_b = EventListener(messaging_repo_class())
+    await listener_a.subscribe_session(task_a.user.session_id)
+    await listener_b.subscribe_session(task_b.user.session_id)
+    events_a, events_b = listener_a.listen(), listener_b.listen()
+
+    for task in [task_b, task_a, task_b]:
+        status_service.store_task(task)
+        event_service.send_event(task.user.session_id, PendingEvent(event_type='pending', task_id=task.task_id))
+
+    session_id, event = await asyncio.wait_for(events_a.__anext__(), timeout=5)
+    assert (session_id, event.task_id) == (task_a.user.session_id, task_a.task_id)
+    for _ in range(2):
+        session_id, event = await asyncio.wait_for(events_b.__anext__(), timeout=5)
+        assert (session_id, event.task_id) == (task_b.user.session_id, task_b.task_id)
+
+    # replica a didn't receive session b's events
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(events_a.__anext__(), timeout=0.5)
+
+    await listener_a.unsubscribe_session(task_a.user.session_id)
+    await listener_b.unsubscribe_session(task_b.user.session_id)
+
+
+@pytest.mark.asyncio
+async def test_events_after_last_seen_event(messaging_repo_class, key_value_repo_class):
+    status_service = StatusService(key_value_repo_class())
+    event_service = EventService(messaging_repo_class(), status_service)
+    task = make_task()
+    status_service.store_task(task)
+
+    for event_type in ['pending', 'started']:
+        event_service.send_event(task.user.session_id, parse_obj_as(EventUnion, {
+            'event_type': event_type,
+            'task_id': task.task_id,
+        }))
+    pending_event_id = event_service.get_events_after(task.user.session_id, '0')[0].event_id
+    started_event = status_service.get_latest_event(task.task_id)
+
+    # a client that only saw the pending event catches up on the started event, with the id it was sent with
+    assert event_service.get_events_after(task.user.session_id, pending_event_id) == [started_event]
+    assert event_service.get_events_after(task.user.session_id, started_event.event_id) == []
+    assert event_service.get_events_after(make_task().user.session_id, pending_event_id) == []
@@ -0,0 +1,218 @@
+import asyncio
+import math
+import uuid
+from typing import Optional, Sequence, Union
+
+import pytest
+
+
+def make_consumer(repo, timeout: float = 60) -> str:
+    consumer = f'consumer:{uuid.uuid4()}'
+    repo.heartbeat(consumer, timeout)
+    return consumer
+
+
+def decode(message: Union[str, bytes]) -> str:
+    # redis returns raw bytes
+    return message.decode('utf-8') if isinstance(message, bytes) else message
+
+
+async def pop(repo, queue: Union[str, Sequence[str]], consumer: Optional[str]) -> str:
+    return decode(await asyncio.wait_for(repo.pop(queue, consumer=consumer), timeout=5))
+
+
+async def wait_idle(repo, queue: str, consumer: str) -> None:
+    # a consumer that finds the queue empty waits for messages
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(repo.pop(queue, consumer=consumer), timeout=0.1)
+
+
+@pytest.mark.asyncio
+async def test_one_preemption_per_waiting_message(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    busy = [make_consumer(repo) for _ in range(3)]
+
+    repo.push(queue, 'a')
+    assert repo.claim_preemption(busy[0], queue)
+    assert not repo.claim_preemption(busy[1], queue)
+
+    repo.push(queue, 'b')
+    assert repo.claim_preemption(busy[1], queue)
+    assert not repo.claim_preemption(busy[2], queue)
+
+    # a claim is released when its consumer pops
+    assert await pop(repo, queue, busy[0]) == 'a'
+    assert not repo.claim_preemption(busy[2], queue)
+    repo.push(queue, 'c')
+    assert repo.claim_preemption(busy[2], queue)
+
+
+@pytest.mark.asyncio
+async def test_no_preemption_while_consumer_idle(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    busy, idle = make_consumer(repo), make_consumer(repo)
+    await wait_idle(repo, queue, idle)
+
+    repo.push(queue, 'a')
+    assert not repo.claim_preemption(busy, queue)
+
+    # once the idle consumer took its message, the next one may preempt
+    assert await pop(repo, queue, idle) == 'a'
+    repo.push(queue, 'b')
+    assert repo.claim_preemption(busy, queue)
+
+
+@pytest.mark.asyncio
+async def test_idle_consumer_without_heartbeat_is_ignored(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    busy, idle = make_consumer(repo), make_consumer(repo, timeout=0.2)
+    await wait_idle(repo, queue, idle)
+
+    repo.push(queue, 'a')
+    assert not repo.claim_preemption(busy, queue)
+    await asyncio.sleep(0.3)
+    assert repo.claim_preemption(busy, queue)
+
+
+@pytest.mark.asyncio
+async def test_recover_redelivers_after_heartbeat_timeout(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    consumer = make_consumer(repo, timeout=0.2)
+    repo.push(queue, 'a')
+    assert await pop(repo, queue, consumer) == 'a'
+    assert repo.delivery_attempts(consumer, 'a') == 1
+
+    # still in flight while the consumer sends heartbeats
+    repo.recover()
+    assert repo.queue_length(queue) == 0
+
+    for attempts in [2, 3]:
+        # other consumers' heartbeats may recover it first
+        await asyncio.sleep(0.3)
+        repo.recover()
+        assert repo.queue_length(queue) == 1
+
+        consumer = make_consumer(repo, timeout=0.2)
+        assert await pop(repo, queue, consumer) == 'a'
+        assert repo.delivery_attempts(consumer, 'a') == attempts
+
+    # acknowledged messages aren't redelivered
+    repo.ack(consumer, 'a')
+    await asyncio.sleep(0.3)
+    repo.recover()
+    assert repo.queue_length(queue) == 0
+
+    # the count starts over for a message pushed again
+    repo.push(queue, 'a')
+    consumer = make_consumer(repo)
+    assert await pop(repo, queue, consumer) == 'a'
+    assert repo.delivery_attempts(consumer, 'a') == 1
+
+
+@pytest.mark.asyncio
+async def test_pop_takes_turns_between_groups(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    for group, messages in [('a', ['a1', 'a2', 'a3']), ('b', ['b1']), ('c', ['c1', 'c2'])]:
+        for message in messages:
+            repo.push(queue, message, group=group)
+
+    popped = [await pop(repo, queue, None) for _ in range(6)]
+    assert popped == ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+    assert repo.queue_length(queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_pop_orders_by_score_within_group(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    repo.push(queue, 'late', score=3)
+    repo.push(queue, 'early', score=1)
+    repo.push(queue, 'middle', score=2)
+    repo.push(queue, 'requeued', score=-math.inf)
+
+    popped = [await pop(repo, queue, None) for _ in range(4)]
+    assert popped == ['requeued', 'early', 'middle', 'late']
+
+
+@pytest.mark.asyncio
+async def test_pop_prefers_higher_priority_queues(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    high, low = f'{queue}:high', f'{queue}:low'
+    repo.push(low, 'low1', group='a')
+    repo.push(low, 'low2', group='b')
+    repo.push(high, 'high1', group='a')
+    repo.push(high, 'high2', group='b')
+
+    popped = [await pop(repo, [high, low], None) for _ in range(4)]
+    assert popped == ['high1', 'high2', 'low1', 'low2']
+
+
+@pytest.mark.asyncio
+async def test_each_message_reaches_one_of_many_waiting_consumers(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    high, low = f'{queue}:high', f'{queue}:low'
+    # consumers that wait for both queues may take a message of the higher priority one instead of the one they were
+    # woken for, while the consumer woken for that finds nothing
+    consumers = [asyncio.create_task(repo.pop([[high], [high, low], [low]][i % 3])) for i in range(50)]
+    await asyncio.sleep(0.1)
+
+    # a consumer that stops waiting doesn't take messages along
+    consumers[0].cancel()
+    messages = {f'm{i}' for i in range(30)}
+    for i, message in enumerate(sorted(messages)):
+        repo.push(high if i % 3 == 1 else low, message)
+
+    # redis consumers check for messages at least every second
+    for _ in range(30):
+        done = [task for task in consumers[1:] if task.done()]
+        if len(done) == len(messages):
+            break
+        await asyncio.sleep(0.1)
+    assert {decode(task.result()) for task in done} == messages
+    for task in consumers:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_queue_rank(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    for score in [1, 2, 3, 4]:
+        repo.push(queue, f'm{score}', group='a', score=score)
+    assert await pop(repo, queue, None) == 'm1'
+    repo.push(queue, 'requeued', group='a', score=-math.inf)
+    repo.push(queue, 'middle', group='a', score=2.5)
+
+    assert [repo.queue_rank(queue, 'a', score) for score in [-math.inf, 2, 2.5, 3, 5]] == [0, 1, 2, 3, 5]
+    assert repo.queue_rank(queue, 'b', 1) == 0
+    assert [await pop(repo, queue, None) for _ in range(5)] == ['requeued', 'm2', 'middle', 'm3', 'm4']
+
+
+def test_log_reads_messages_after_id(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    log = f'{queue}:log'
+    ids = [repo.append(log, f'm{i}', max_length=100, ttl=60) for i in range(5)]
+
+    assert repo.read_after(log, ids[1]) == [(ids[i], f'm{i}') for i in range(2, 5)]
+    assert repo.read_after(log, ids[4]) == []
+    with pytest.raises(ValueError):
+        repo.read_after(log, 'not an id')
+
+
+def test_log_is_capped(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    log = f'{queue}:log'
+    ids = [repo.append(log, f'm{i}', max_length=10, ttl=60) for i in range(1000)]
+
+    # redis trims approximately, but keeps at least the latest messages
+    entries = repo.read_after(log, ids[0])
+    assert 10 <= len(entries) < 500
+    assert entries == [(ids[i], f'm{i}') for i in range(1000 - len(entries), 1000)]
+
+
+@pytest.mark.asyncio
+async def test_log_expires(messaging_repo_class, queue):
+    repo = messaging_repo_class()
+    log = f'{queue}:log'
+    first_id = repo.append(log, 'first', max_length=10, ttl=0.2)
+    repo.append(log, 'second', max_length=10, ttl=0.2)
+    await asyncio.sleep(0.3)
+    assert repo.read_after(log, first_id) == []
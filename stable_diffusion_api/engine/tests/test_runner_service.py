@@ -0,0 +1,163 @@
+from unittest import mock
+
+import pytest
+import torch
+from diffusers import PNDMScheduler
+
+from stable_diffusion_api.engine.repos.key_value_repo import InMemoryKeyValueRepo
+from stable_diffusion_api.engine.services import runner_service as runner_service_module
+from stable_diffusion_api.engine.services.runner_service import RunnerService
+from stable_diffusion_api.engine.services.status_service import StatusService
+from stable_diffusion_api.engine.tests.conftest import make_task
+from stable_diffusion_api.models.events import AbortedEvent
+from stable_diffusion_api.models.results import GeneratedBlob
+
+
+class FakeOutput:
+    def __init__(self, images):
+        self.images = images
+
+
+class FakePipeline:
+    # runs the denoising loop of the stable diffusion pipeline with a real scheduler, but a fake unet
+
+    def __init__(self, scheduler=None, **kwargs):
+        self.scheduler = scheduler or PNDMScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear",
+            skip_prk_steps=True,
+        )
+
+    def to(self, device):
+        return self
+
+    def text2img(self, num_inference_steps, generator, height, width, latents=None, callback=None, **kwargs):
+        if latents is None:
+            latents = torch.randn((1, 4, height // 8, width // 8), generator=generator)
+        self.scheduler.set_timesteps(num_inference_steps)
+        latents = latents * self.scheduler.init_noise_sigma
+        for i, t in enumerate(self.scheduler.timesteps):
+            latent_model_input = self.scheduler.scale_model_input(latents, t)
+            noise_pred = torch.sin(latent_model_input * 3 + float(t) / 100)
+            latents = self.scheduler.step(noise_pred, t, latents).prev_sample
+            if callback is not None:
+                callback(i, t, latents)
+        return FakeOutput([latents])
+
+
+@pytest.fixture
+def runner_service(monkeypatch):
+    monkeypatch.setattr(runner_service_module.DiffusionPipeline, 'from_pretrained', FakePipeline)
+    runner_service = RunnerService(
+        blob_repo=mock.Mock(),
+        status_service=StatusService(InMemoryKeyValueRepo()),
+        event_service=mock.Mock(),
+        task_service=mock.Mock(),
+        metrics_service=mock.Mock(),
+    )
+    runner_service.outputs = []
+
+    def save_img(img, task):
+        runner_service.outputs.append(img)
+        return GeneratedBlob(blob_url='blob', parameters_used=task.parameters)
+
+    runner_service.save_img = save_img
+    return runner_service
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('scheduler', ['plms', 'ddim', 'k-lms'])
+@pytest.mark.parametrize('preempt_at_step', [1, 4, 7])
+async def test_resumed_run_matches_uninterrupted_run(runner_service, scheduler, preempt_at_step):
+    def make_params_task():
+        task = make_task()
+        task.parameters.steps = 10
+        task.parameters.width = task.parameters.height = 64
+        task.parameters.scheduler = scheduler
+        task.parameters.seed = 42
+        return task
+
+    runner_service.task_service.claim_preemption.return_value = False
+    await runner_service.run_task(make_params_task(), 'consumer')
+    uninterrupted = runner_service.outputs.pop()
+
+    # yield to a higher priority task after some steps, then resume from the checkpoint
+    task = make_params_task()
+    runner_service.task_service.claim_preemption.side_effect = (
+        lambda consumer, priority: runner_service.task_service.claim_preemption.call_count == preempt_at_step
+    )
+    runner_service.task_service.claim_preemption.reset_mock()
+    await runner_service.run_task(task, 'consumer')
+    assert not runner_service.outputs
+    runner_service.task_service.requeue_task.assert_called_once_with(task)
+    assert runner_service.status_service.get_checkpoint(task.task_id) is not None
+
+    await runner_service.run_task(task, 'consumer')
+    resumed = runner_service.outputs.pop()
+
+    assert torch.equal(resumed, uninterrupted)
+    assert runner_service.status_service.get_checkpoint(task.task_id) is None
+
+
+def make_txt2img_task():
+    task = make_task()
+    task.parameters.steps = 4
+    task.parameters.width = task.parameters.height = 64
+    task.parameters.seed = 42
+    return task
+
+
+@pytest.mark.asyncio
+async def test_task_aborted_after_max_delivery_attempts(runner_service):
+    runner_service.max_delivery_attempts = 2
+    runner_service.task_service.claim_preemption.return_value = False
+
+    await runner_service.run_task(make_txt2img_task(), 'consumer', delivery_attempts=2)
+    assert len(runner_service.outputs) == 1
+
+    task = make_txt2img_task()
+    runner_service.event_service.reset_mock()
+    await runner_service.run_task(task, 'consumer', delivery_attempts=3)
+    assert len(runner_service.outputs) == 1
+    (session_id, event), _ = runner_service.event_service.send_event.call_args
+    assert isinstance(event, AbortedEvent)
+    assert event.task_id == task.task_id
+
+
+@pytest.mark.asyncio
+async def test_unreadable_checkpoint_restarts_task(runner_service):
+    runner_service.task_service.claim_preemption.return_value = False
+    await runner_service.run_task(make_txt2img_task(), 'consumer')
+    uninterrupted = runner_service.outputs.pop()
+
+    task = make_txt2img_task()
+    runner_service.status_service.store_checkpoint(task.task_id, b'not a checkpoint')
+    await runner_service.run_task(task, 'consumer')
+
+    assert torch.equal(runner_service.outputs.pop(), uninterrupted)
+    assert runner_service.status_service.get_checkpoint(task.task_id) is None
+
+
+@pytest.mark.asyncio
+async def test_expired_task_aborted_unless_started(runner_service):
+    runner_service.task_service.claim_preemption.return_value = False
+    task = make_txt2img_task()
+    task.deadline = 0
+    await runner_service.run_task(task, 'consumer')
+    assert not runner_service.outputs
+    (session_id, event), _ = runner_service.event_service.send_event.call_args
+    assert isinstance(event, AbortedEvent)
+
+    # a task that yielded to a higher priority task after its start resumes past its deadline
+    task = make_txt2img_task()
+    runner_service.task_service.claim_preemption.side_effect = (
+        lambda consumer, priority: runner_service.task_service.claim_preemption.call_count == 1
+    )
+    runner_service.task_service.claim_preemption.reset_mock()
+    await runner_service.run_task(task, 'consumer')
+    assert runner_service.status_service.get_checkpoint(task.task_id) is not None
+
+    task.deadline = 0
+    await runner_service.run_task(task, 'consumer')
+    assert len(runner_service.outputs) == 1
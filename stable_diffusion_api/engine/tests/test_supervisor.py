@@ -0,0 +1,98 @@
+from unittest import mock
+
+import pytest
+
+from stable_diffusion_api.engine.workers import supervisor
+from stable_diffusion_api.engine.workers.supervisor import WorkerSupervisor, get_default_num_processes, split_cores
+
+
+@pytest.mark.parametrize('cores, num_processes, expected', [
+    ([0, 1, 2, 3], 1, [[0, 1, 2, 3]]),
+    ([0, 1, 2, 3], 2, [[0, 1], [2, 3]]),
+    ([0, 1, 2, 3, 4], 2, [[0, 1, 2], [3, 4]]),
+    ([2, 3, 5, 7], 4, [[2], [3], [5], [7]]),
+])
+def test_split_cores(cores, num_processes, expected):
+    assert split_cores(cores, num_processes) == expected
+
+
+@pytest.mark.parametrize('num_processes', [0, -1, 5])
+def test_split_cores_rejects_invalid_process_count(num_processes):
+    with pytest.raises(ValueError):
+        split_cores([0, 1, 2, 3], num_processes)
+
+
+def test_default_num_processes():
+    assert get_default_num_processes(list(range(16))) == 5
+    assert get_default_num_processes([0, 1]) == 2
+
+
+class FakeProcess:
+    name = 'fake_worker'
+    exitcode = 1
+
+    def __init__(self, alive: bool = True):
+        self.alive = alive
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = mock.Mock(return_value=0.0)
+    monkeypatch.setattr(supervisor.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def worker_supervisor(clock) -> WorkerSupervisor:
+    worker_supervisor = WorkerSupervisor([[0]], restart_delay=1.0, max_restart_delay=8.0)
+
+    def start_process(index: int):
+        worker_supervisor.processes[index] = FakeProcess()
+        worker_supervisor.started_at[index] = clock()
+
+    worker_supervisor.start_process = mock.Mock(side_effect=start_process)
+    return worker_supervisor
+
+
+def crash(worker_supervisor: WorkerSupervisor):
+    worker_supervisor.processes[0].alive = False
+
+
+def test_restart_backoff_doubles_while_crashing(worker_supervisor, clock):
+    worker_supervisor.check_processes()
+    assert worker_supervisor.start_process.call_count == 1
+
+    for expected_delay in [2.0, 4.0, 8.0, 8.0]:
+        crash(worker_supervisor)
+        worker_supervisor.check_processes()
+        assert worker_supervisor.delays[0] == expected_delay
+        calls = worker_supervisor.start_process.call_count
+
+        # not restarted before the delay passed
+        clock.return_value += expected_delay - 0.5
+        worker_supervisor.check_processes()
+        assert worker_supervisor.start_process.call_count == calls
+
+        clock.return_value += 0.5
+        worker_supervisor.check_processes()
+        assert worker_supervisor.start_process.call_count == calls + 1
+
+
+def test_restart_backoff_resets_after_stable_run(worker_supervisor, clock):
+    worker_supervisor.check_processes()
+    crash(worker_supervisor)
+    worker_supervisor.check_processes()
+    assert worker_supervisor.delays[0] == 2.0
+
+    clock.return_value += 2.0
+    worker_supervisor.check_processes()
+
+    # the worker ran for longer than the maximum delay before exiting
+    clock.return_value += 100.0
+    crash(worker_supervisor)
+    worker_supervisor.check_processes()
+    assert worker_supervisor.delays[0] == 1.0
+    assert worker_supervisor.restart_at[0] == clock.return_value + 1.0
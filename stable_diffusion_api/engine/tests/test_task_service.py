@@ -0,0 +1,104 @@
+from unittest import mock
+
+import pytest
+
+from stable_diffusion_api.engine.services import task_service as task_service_module
+from stable_diffusion_api.engine.services.event_service import EventService
+from stable_diffusion_api.engine.services.metrics_service import MetricsService
+from stable_diffusion_api.engine.services.status_service import StatusService
+from stable_diffusion_api.engine.services.task_service import TaskService, get_task_group
+from stable_diffusion_api.engine.tests.conftest import make_task
+from stable_diffusion_api.models.task import SchedulingPolicy, Task
+from stable_diffusion_api.models.user import DefaultUsername
+
+
+def test_users_are_grouped_by_username():
+    assert get_task_group(make_task('alice')) == get_task_group(make_task('alice')) == 'alice'
+    assert get_task_group(make_task('alice')) != get_task_group(make_task('bob'))
+
+
+def test_public_user_is_grouped_by_session():
+    task = make_task(DefaultUsername)
+    same_session_task = Task(parameters=task.parameters, user=task.user)
+    assert get_task_group(task) == get_task_group(same_session_task)
+    assert get_task_group(task) != get_task_group(make_task(DefaultUsername))
+
+
+def make_sjf_task_service(seconds_by_steps: dict[int, float]) -> TaskService:
+    metrics_service = mock.Mock()
+    metrics_service.estimate_task_seconds.side_effect = lambda params: seconds_by_steps[params.steps]
+    return TaskService(
+        messaging_repo=mock.Mock(),
+        event_service=mock.Mock(),
+        status_service=mock.Mock(),
+        metrics_service=metrics_service,
+        scheduling_policy="sjf",
+        sjf_aging_factor=10,
+    )
+
+
+def make_policy_task(policy: SchedulingPolicy, steps: int, created_at: float) -> Task:
+    task = make_task(created_at=created_at, scheduling_policy=policy)
+    task.parameters.steps = steps
+    return task
+
+
+def test_fifo_score_is_creation_time():
+    task_service = make_sjf_task_service({})
+    assert task_service.get_score(make_policy_task("fifo", 50, created_at=1000)) == 1000
+
+
+def test_sjf_score_prefers_cheaper_tasks():
+    task_service = make_sjf_task_service({50: 100, 5: 10})
+    expensive = make_policy_task("sjf", 50, created_at=1000)
+    cheap = make_policy_task("sjf", 5, created_at=1001)
+    assert task_service.get_score(expensive) == 1000 + 10 * 100
+    assert task_service.get_score(cheap) < task_service.get_score(expensive)
+
+
+def test_sjf_aging_bounds_how_long_a_task_is_passed_over():
+    task_service = make_sjf_task_service({50: 100, 0: 0})
+    expensive = make_policy_task("sjf", 50, created_at=1000)
+    # even tasks that cost nothing only pass it for the aging factor times its estimated duration
+    assert task_service.get_score(make_policy_task("sjf", 0, created_at=1999)) < task_service.get_score(expensive)
+    assert task_service.get_score(make_policy_task("sjf", 0, created_at=2001)) > task_service.get_score(expensive)
+
+
+@pytest.fixture
+def queued_task_service(monkeypatch, queue, messaging_repo_class, key_value_repo_class) -> TaskService:
+    # queue tasks apart from the task queues that the apps' runners pop
+    monkeypatch.setattr(task_service_module, 'get_task_queue', lambda priority: f'{queue}:{priority}')
+    monkeypatch.setattr(task_service_module, 'task_queues', [f'{queue}:interactive', f'{queue}:batch'])
+    key_value_repo = key_value_repo_class()
+    status_service = StatusService(key_value_repo)
+    return TaskService(
+        messaging_repo=messaging_repo_class(),
+        event_service=EventService(messaging_repo_class(), status_service),
+        status_service=status_service,
+        metrics_service=MetricsService(key_value_repo),
+    )
+
+
+def test_queue_position_counts_users_ahead_in_rotation(queued_task_service):
+    tasks = [make_task(f'user{i}') for i in range(100)]
+    for task in tasks:
+        queued_task_service.push_task(task)
+
+    for position, task in enumerate(tasks):
+        assert queued_task_service.estimate_queue_position(task) == position
+
+
+def test_queue_position_counts_own_tasks_ahead(queued_task_service):
+    a1, a2, a3, b1 = make_task('a'), make_task('a'), make_task('a'), make_task('b')
+    for task in [a1, a2, a3, b1]:
+        queued_task_service.push_task(task)
+
+    # popped in order a1, b1, a2, a3
+    positions = [queued_task_service.estimate_queue_position(task) for task in [a1, b1, a2, a3]]
+    assert positions == [0, 1, 2, 3]
+
+    # higher priority tasks come first
+    interactive = make_task('c', priority="interactive")
+    queued_task_service.push_task(interactive)
+    assert queued_task_service.estimate_queue_position(interactive) == 0
+    assert queued_task_service.estimate_queue_position(a3) == 4
@@ -8,9 +8,10 @@ from stable_diffusion_api.engine.repos.blob_repo import RedisBlobRepo
 from stable_diffusion_api.engine.repos.key_value_repo import RedisKeyValueRepo
 from stable_diffusion_api.engine.repos.messaging_repo import RedisMessagingRepo
 from stable_diffusion_api.engine.services.event_service import EventService
+from stable_diffusion_api.engine.services.metrics_service import MetricsService
 from stable_diffusion_api.engine.services.runner_service import RunnerService
 from stable_diffusion_api.engine.services.status_service import StatusService
-from stable_diffusion_api.engine.services.task_service import TaskListener
+from stable_diffusion_api.engine.services.task_service import TaskListener, TaskService
 from stable_diffusion_api.engine.workers.utils import get_runner_coroutine, get_local_blob_repo_params
 from stable_diffusion_api.models.task import Task
 
@@ -33,11 +34,25 @@ def create_runner() -> Coroutine[Task, None, None]:
     event_service = EventService(
         messaging_repo=messaging_repo,
         status_service=status_service,
+        event_log_length=int(os.environ.get('EVENT_LOG_LENGTH', 100)),
+    )
+    metrics_service = MetricsService(
+        key_value_repo=key_value_repo,
+    )
+    task_service = TaskService(
+        messaging_repo=messaging_repo,
+        event_service=event_service,
+        status_service=status_service,
+        metrics_service=metrics_service,
     )
     runner_service = RunnerService(
         blob_repo=blob_repo,
         status_service=status_service,
         event_service=event_service,
+        task_service=task_service,
+        metrics_service=metrics_service,
+        checkpoint_interval=int(os.environ.get('CHECKPOINT_INTERVAL', 10)),
+        max_delivery_attempts=int(os.environ.get('MAX_DELIVERY_ATTEMPTS', 3)),
     )
 
     # listen for tasks
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from multiprocessing.process import BaseProcess
+from typing import Optional, Sequence
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKER_PROCESSES = 5
+
+
+def get_available_cores() -> list[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: Sequence[int], num_processes: int) -> list[list[int]]:
+    # split cores into disjoint, contiguous sets (neighbouring cores tend to share caches)
+    if num_processes < 1:
+        raise ValueError(f'Cannot run {num_processes} worker processes, need at least 1')
+    if num_processes > len(cores):
+        raise ValueError(f'Cannot pin {num_processes} worker processes to {len(cores)} cores')
+    core_sets = []
+    per_process, remainder = divmod(len(cores), num_processes)
+    start = 0
+    for i in range(num_processes):
+        end = start + per_process + (1 if i < remainder else 0)
+        core_sets.append(list(cores[start:end]))
+        start = end
+    return core_sets
+
+
+def run_pinned_worker(cores: list[int]) -> None:
+    # limit the intra-op thread pools before torch is imported,
+    # so the runner doesn't oversubscribe cores owned by its siblings
+    num_threads = str(len(cores))
+    os.environ['OMP_NUM_THREADS'] = num_threads
+    os.environ['MKL_NUM_THREADS'] = num_threads
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+
+    from stable_diffusion_api.engine.workers.redis_worker import create_runner
+
+    logger.info(f'Worker process {os.getpid()} pinned to cores {cores}')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(create_runner())
+
+
+class WorkerSupervisor:
+    def __init__(
+        self,
+        core_sets: list[list[int]],
+        restart_delay: float = 1.0,
+        max_restart_delay: float = 60.0,
+    ):
+        self.core_sets = core_sets
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        # spawn, so that children don't inherit torch/redis state from the supervisor
+        self.context = multiprocessing.get_context('spawn')
+        self.processes: list[Optional[BaseProcess]] = [None] * len(core_sets)
+        self.started_at: list[float] = [0.0] * len(core_sets)
+        self.restart_at: list[float] = [0.0] * len(core_sets)
+        self.delays: list[float] = [restart_delay] * len(core_sets)
+        self.stopping = False
+
+    def start_process(self, index: int) -> None:
+        process = self.context.Process(
+            target=run_pinned_worker,
+            args=(self.core_sets[index],),
+            name=f'redis_worker_{index}',
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+
+    def check_processes(self) -> None:
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                continue
+
+            if process is not None:
+                logger.error(f'Worker {process.name} exited with code {process.exitcode}, restarting')
+                self.processes[index] = None
+                # back off if the worker keeps crashing on startup, reset once it has been up for a while
+                if now - self.started_at[index] < self.max_restart_delay:
+                    self.delays[index] = min(self.delays[index] * 2, self.max_restart_delay)
+                else:
+                    self.delays[index] = self.restart_delay
+                self.restart_at[index] = now + self.delays[index]
+
+            if now >= self.restart_at[index]:
+                self.start_process(index)
+
+    def stop(self, *_) -> None:
+        self.stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(len(self.core_sets)):
+            self.start_process(index)
+
+        while not self.stopping:
+            self.check_processes()
+            time.sleep(1)
+
+        logger.info('Stopping worker processes')
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+
+def get_default_num_processes(cores: Sequence[int]) -> int:
+    # as many runners as the deployment used to run as replicas, unless there are fewer cores
+    return max(min(DEFAULT_WORKER_PROCESSES, len(cores)), 1)
+
+
+def create_supervisor() -> WorkerSupervisor:
+    cores = get_available_cores()
+    num_processes = int(os.environ.get('WORKER_PROCESSES') or get_default_num_processes(cores))
+    core_sets = split_cores(cores, num_processes)
+    logger.info(f'Starting worker supervisor with {num_processes} processes on {len(cores)} cores')
+    return WorkerSupervisor(core_sets)
+
+
+if __name__ == '__main__':
+    create_supervisor().run()
@@ -1,17 +1,48 @@
 import asyncio
+import logging
 import os
+import threading
 from typing import Coroutine
 
 from stable_diffusion_api.models.task import Task
 
+logger = logging.getLogger(__name__)
+
+
+def start_heartbeat(task_listener, interval: float = 10) -> threading.Event:
+    # register the listener before it pops any tasks
+    task_listener.heartbeat()
+    # set to stop sending heartbeats, so the listener's tasks are redelivered
+    stopped = threading.Event()
+
+    # runs in a thread, because the pipeline blocks the event loop while a task runs
+    def heartbeat_loop():
+        while not stopped.wait(interval):
+            try:
+                task_listener.heartbeat()
+            except Exception as e:
+                logger.exception(f"Error sending heartbeat: {e}")
+
+    thread = threading.Thread(target=heartbeat_loop, daemon=True)
+    thread.start()
+    return stopped
+
 
 def get_runner_coroutine(task_listener, runner_service) -> Coroutine[Task, None, None]:
     async def runner_loop():
+        heartbeat_stopped = start_heartbeat(task_listener)
         try:
             async for task in task_listener.listen():
-                await runner_service.run_task(task)
+                try:
+                    await runner_service.run_task(
+                        task, task_listener.consumer, task_listener.get_delivery_attempts(task)
+                    )
+                finally:
+                    task_listener.ack_task(task)
         except Exception as e:
-            print(f"Error running task: {e}")
+            logger.exception(f"Error running task: {e}")
+        finally:
+            heartbeat_stopped.set()
 
     return runner_loop()
 
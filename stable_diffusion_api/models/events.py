@@ -1,4 +1,4 @@
-from typing import Union, Literal
+from typing import Union, Literal, Optional
 
 import pydantic
 
@@ -12,10 +12,26 @@ class Event(pydantic.BaseModel):
 
     task_id: TaskId
 
+    event_id: Optional[str] = pydantic.Field(
+        default=None,
+        description="Pass as `last_event_id` when reconnecting to `/events`, "
+                    "to receive the session's events sent after this one."
+    )
+
 
 class PendingEvent(Event):
     event_type: Literal['pending']
 
+    queue_position: Optional[int] = pydantic.Field(
+        default=None,
+        description="The estimated number of tasks that will be started before this task."
+    )
+    eta: Optional[float] = pydantic.Field(
+        default=None,
+        description="The estimated number of seconds until this task is finished, "
+                    "based on the throughput workers measured recently."
+    )
+
 
 class StartedEvent(Event):
     event_type: Literal['started']
@@ -83,6 +83,10 @@ class Params(pydantic.BaseModel):
                     "If not set, a random seed is used."
     )
 
+    def cost(self) -> float:
+        # relative cost of generation, in denoising steps of a 512x512 image
+        return float(self.steps)
+
 
 class Txt2ImgParams(Params):
     params_type: Literal['txt2img'] = "txt2img"
@@ -98,6 +102,9 @@ class Txt2ImgParams(Params):
         default=512,
         description="The pixel height of the generated image.")
 
+    def cost(self) -> float:
+        return self.steps * self.width * self.height / (512 * 512)
+
 
 class Img2ImgParams(Params):
     params_type: Literal['img2img'] = 'img2img'
@@ -122,6 +129,10 @@ class Img2ImgParams(Params):
                     "A value of 1, therefore, works like Txt2Img, essentially ignoring the reference image."
     )
 
+    def cost(self) -> float:
+        # only the last `strength` fraction of the steps is run
+        return self.steps * self.strength
+
 
 class InpaintParams(Params):
     params_type: Literal['inpaint'] = 'inpaint'
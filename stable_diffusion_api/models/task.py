@@ -1,4 +1,6 @@
+import time
 import uuid
+from typing import Literal, Optional
 
 import pydantic
 from typing_extensions import TypeAlias
@@ -8,9 +10,25 @@ from stable_diffusion_api.models.user import User
 
 TaskId: TypeAlias = str
 
+# ordered from highest to lowest priority
+TaskPriority = Literal["interactive", "batch"]
+
+# how tasks of the same priority and user are ordered in the queue
+SchedulingPolicy = Literal["fifo", "sjf"]
+
 
 class Task(pydantic.BaseModel):
     parameters: ParamsUnion
 
     user: User
     task_id: TaskId = pydantic.Field(default_factory=lambda: TaskId(uuid.uuid4()))
+    priority: TaskPriority = "batch"
+    scheduling_policy: SchedulingPolicy = "fifo"
+    created_at: float = pydantic.Field(default_factory=time.time)
+    # score the task was queued with, None if it was queued at the front
+    queue_score: Optional[float] = None
+    # unix time after which nobody waits for the result, so the task is dropped if it hasn't finished
+    deadline: Optional[float] = None
+
+    def is_expired(self) -> bool:
+        return self.deadline is not None and time.time() > self.deadline